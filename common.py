@@ -6,6 +6,7 @@ from __future__ import print_function
 __author__ = 'ayasin'
 
 import sys, os, re, pickle
+from array import array
 from subprocess import check_output, Popen
 
 # logging
@@ -156,6 +157,104 @@ def read_perf_toplev(filename):
       else: d[x] = v
   return d
 
+NaN = float('nan')
+
+# Series - per-interval, per-CPU time series of events, e.g. of an interval-mode or per-CPU collection
+#   times:   timestamps of intervals in order of appearance; index maps a timestamp to its position
+#   data:    an array of values per (event, CPU), aligned to times; NaN where it had no value
+#   unknown: events with no value at all, e.g. <not counted>
+class Series(object):
+  def __init__(self):
+    self.times, self.index, self.data, self.unknown = array('d'), {}, {}, set()
+
+  def add(self, t, cpu, event, v):
+    i = self.index.get(t)
+    if i is None:
+      i = self.index[t] = len(self.times)
+      self.times.append(t)
+    a = self.data.get((event, cpu))
+    if a is None: a = self.data[(event, cpu)] = array('d')
+    if len(a) <= i: a.extend([NaN] * (i + 1 - len(a)))
+    a[i] = v
+
+  def events(self): return sorted(set(e for e, c in self.data))
+  def cpus(self, event=None): return sorted(set(c for e, c in self.data if event is None or e == event))
+
+  # series - values of event on cpu for all intervals
+  def series(self, event, cpu):
+    a = self.data.get((event, cpu), array('d'))
+    return a + array('d', [NaN] * (len(self.times) - len(a)))
+
+  # sum, mean - per interval, over cpus (all by default), skipping missing values; NaN for an interval w/o any
+  def sum(self, event, cpus=None):
+    s = array('d', [NaN] * len(self.times))
+    for c in cpus or self.cpus(event):
+      for i, v in enumerate(self.series(event, c)):
+        if v == v: s[i] = v if s[i] != s[i] else s[i] + v
+    return s
+
+  def mean(self, event, cpus=None):
+    s, n = self.sum(event, cpus), array('d', [0.0] * len(self.times))
+    for c in cpus or self.cpus(event):
+      for i, v in enumerate(self.series(event, c)):
+        if v == v: n[i] += 1
+    return array('d', [x / k if k else NaN for x, k in zip(s, n)])
+
+  # per_socket - per-interval sums by socket, as mapped from a CPU by socket_of
+  def per_socket(self, event, socket_of=None):
+    socket_of = socket_of or cpu_socket
+    sockets = {}
+    for c in self.cpus(event): sockets.setdefault(socket_of(c), []).append(c)
+    return {s: self.sum(event, cs) for s, cs in sockets.items()}
+
+  def total(self, event, cpus=None): return sum(v for v in self.sum(event, cpus) if v == v)
+
+# cpu_socket - socket of a CPU column, e.g. S1-C3 or CPU12 (per sysfs); 0 when unknown
+def cpu_socket(cpu):
+  m = re.match(r"S(\d+)", cpu)
+  if m: return int(m.group(1))
+  m = re.match(r"CPU(\d+)", cpu)
+  f = '/sys/devices/system/cpu/cpu%s/topology/physical_package_id' % m.group(1) if m else None
+  return int(file2str(f)) if f and os.path.isfile(f) else 0
+
+# read_perf_toplev_series - stream a toplev -V .csv (as perf_fields_tl) into a Series, one row at a time,
+# so memory is proportional to the series rather than to the file. Rows w/o a timestamp or CPU are at 0 or ''.
+def read_perf_toplev_series(filename, series=None):
+  s = series or Series()
+  with open(filename) as csvfile:
+    for r in csv.reader(csvfile):
+      if len(r) < 5 or r[3] in ('Event', 'dummy'): continue
+      try:
+        v = float(r[4])
+      except ValueError:
+        s.unknown.add(r[3])
+        continue
+      try:
+        t = float(r[0]) if r[0] else 0.0
+      except ValueError:
+        continue
+      s.add(t, r[1], r[3], v)
+  s.unknown -= set(e for e, c in s.data)
+  return s
+
+# read_perf_stat_series - stream a perf stat -I -x, log (w/ or w/o -A) into a Series, likewise
+def read_perf_stat_series(filename, series=None):
+  s = series or Series()
+  with open(filename) as csvfile:
+    for r in csv.reader(l for l in csvfile if not l.startswith('#')):
+      cpu = r.pop(1) if len(r) > 1 and r[1].startswith('CPU') else ''
+      if len(r) < 4: continue
+      try:
+        t = float(r[0])
+      except ValueError:
+        continue
+      try:
+        s.add(t, cpu, r[3], float(r[1]))
+      except ValueError:
+        s.unknown.add(r[3])
+  s.unknown -= set(e for e, c in s.data)
+  return s
+
 # auxiliary: strings, argv, python-stuff
 #
 
@@ -229,3 +328,13 @@ def command_basename(comm, iterations=None):
 def ratio(x, histo, denom='total'):
   return '%s-ratio: %.1f%%'%(x, 100.0*histo[x]/max(histo[denom], 1))
 
+
+# mean_ci - mean, half-width of its 95% confidence interval (Student's t) and standard deviation of a sample
+T95 = (12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23, 2.20, 2.18, 2.16, 2.14, 2.13, 2.12, 2.11, 2.10, 2.09,
+       2.09, 2.08, 2.07, 2.07, 2.06, 2.06, 2.06, 2.05, 2.05, 2.05, 2.04)
+def mean_ci(x):
+  n = len(x)
+  mean = sum(x) / float(n)
+  if n < 2: return mean, float('inf'), 0.0
+  sd = (sum((v - mean) ** 2 for v in x) / (n - 1)) ** 0.5
+  return mean, (T95[n - 2] if n - 1 <= len(T95) else 1.96) * sd / n ** 0.5, sd
@@ -17,17 +17,29 @@ from __future__ import print_function
 __author__ = 'ayasin'
 __version__= 1.1
 
-import argparse, os.path, sys
+import argparse, hashlib, json, os.path, resource, subprocess, sys, threading, time
 import common as C
-import pmu
+import lbr, pmu, results
 from datetime import datetime
 from platform import python_version
+from multiprocessing.pool import ThreadPool
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
+try:
+  from Queue import Queue
+  from pipes import quote
+except ImportError:
+  from queue import Queue
+  from shlex import quote
 
 RUN_DEF = './run.sh'
 TOPLEV_DEF='--metric-group +Summary' #FIXME: argparse should tell whether user specified an options
 Find_perf = 'sudo find / -name perf -executable -type f'
 cpu = 'cpu_core' if 'hybrid' in pmu.name() else 'cpu'
 do = {'run':        RUN_DEF,
+  'addr-hist':      'l1i,4k,2m,line', # address-bit ranges to bucket PEBS IPs by, along with DSB sets; see addrbits
   'asm-dump':       30,
   'cmds_file':      None,
   'compiler':       'gcc -O2', # ~/tools/llvm-6.0.0/bin/clang',
@@ -36,10 +48,12 @@ do = {'run':        RUN_DEF,
   'dmidecode':      0,
   'extra-metrics':  "+Mispredictions,+IpTB,+BpTkBranch,+IpCall,+IpLoad,+ILP,+UPI",
   'forgive':        0,
+  'jobs':           4, # of post-processing tasks in profile; 0 runs all commands serially
   'gen-kernel':     1,
   'loops':          3,
   'lbr-stats':      '- 0 10 0 ANY_DSB_MISS',
   'lbr-stats-tk':   '- 0 20 1',
+  'lbr-sample':     None, # e.g. '10' or 'r20000' for a quick look; see LBR_SAMPLE in lbr.py
   'metrics':        "+L2MPKI,+ILP,+IpTB,+IpMispredict", #,+UPI once ICL mux fixed
   'msr':            0,
   'msrs':           ('0x48', '0x8b', '0x1a4'),
@@ -58,18 +72,26 @@ do = {'run':        RUN_DEF,
   'pmu':            pmu.name(),
   'python':         sys.executable,
   'profile':        1,
+  'ptage-top':      0, # e.g. 1000 to count only that many heaviest IPs/instructions, in bounded memory w/o sorts (see ptage)
   'repeat':         3,
+  'repeat-ci':      0, # e.g. 1 to repeat counting steps until the 95% confidence interval of key metrics is within 1% (topdown: 1 %-point)
+  'repeat-max':     20,
+  'results-db':     'results.db', # profile runs are indexed here, see results.py; '' to disable
   'sample':         2,
   'super':          0,
   'tee':            1,
   'toplev':         TOPLEV_DEF,
   'toplev-levels':  2,
   'toplev-full':    '-vl6',
+  'warmup':         0, # ms to skip at start of collection steps; -1 to detect when IPC & instruction rate stabilise
+  'warmup-interval': 100, # ms, of the interval count that detects warm-up
+  'warmup-tolerance': 5, # %, of IPC and instruction rate from those of the rest of the run
+  'window':         0, # ms to collect for, past warm-up; 0 for the rest of the run
   'xed':            1,
 }
 args = argparse.Namespace()
 
-def exe(x, msg=None, redir_out='2>&1', verbose=False, run=True, timeit=False, background=False):
+def exe(x, msg=None, redir_out='2>&1', verbose=False, run=True, timeit=False, background=False, needs=None, makes=[]):
   X=x.split()
   if redir_out: redir_out=' %s'%redir_out
   if not do['tee'] and redir_out: x = x.split('|')[0]
@@ -86,19 +108,161 @@ def exe(x, msg=None, redir_out='2>&1', verbose=False, run=True, timeit=False, ba
     do['cmds_file'].write(x + '\n')
     do['cmds_file'].flush()
     verbose = args.verbose > 0
-  return C.exe_cmd(x, msg, redir_out, verbose, run, background)
+  if needs is not None and run and not background and do['jobs']:
+    if redir_out: x = x.replace(' |', redir_out + ' |', 1) if '|' in x else x + redir_out
+    return task(x, msg, needs, makes, verbose)
+  tasks_wait()
+  if not self_prof['file'] or not run or background: return C.exe_cmd(x, msg, redir_out, verbose, run, background)
+  t, u = time.time(), resource.getrusage(resource.RUSAGE_CHILDREN)
+  C.exe_cmd(x, msg, redir_out, verbose, run, background)
+  self_prof_add(x, t, u, resource.getrusage(resource.RUSAGE_CHILDREN))
 def exe_to_null(x): return exe(x + ' > /dev/null', redir_out=None)
 def exe_v0(x='true', msg=None): return C.exe_cmd(x, msg) # don't append to cmds_file
 def prn_line(f): exe_v0('echo >> %s' % f)
 
 def print_cmd(x, show=True):
-  if show: C.printc(x)
+  if show:
+    if len(tasks['list']): task_note(C.color.DARKCYAN + x + C.color.END + '\n')
+    else: C.printc(x)
   if len(vars(args))>0: do['cmds_file'].write('# ' + x + '\n')
 
+#
+# tasks: post-processing commands of profile() run by a pool of do['jobs'] threads, each once earlier tasks that make
+# the files it needs, or use the files it makes, are done. Any other command waits for all tasks, so collection runs are never disturbed, and outputs
+# are shown in the order tasks were added. A task is a shell command or a function that returns its output.
+#
+tasks = {'list': [], 'pool': None, 'lock': threading.Lock()}
+
+def task(x, msg=None, needs=[], makes=[], verbose=False):
+  if not do['jobs']:
+    exe_v0(msg=msg)
+    return sys.stdout.write(x())
+  t = {'cmd': x, 'msg': msg, 'needs': needs, 'makes': makes, 'verbose': verbose}
+  deps = [d['result'] for d in tasks['list'] if set(d['makes']) & set(needs + makes) or set(d['needs']) & set(makes)]
+  if not tasks['pool']: tasks['pool'] = ThreadPool(do['jobs'])
+  t['result'] = tasks['pool'].apply_async(task_run, (x, deps))
+  tasks['list'].append(t)
+
+def task_run(x, deps):
+  for d in deps: d.wait() # these were queued earlier, so none is waiting for a free thread
+  t = time.time()
+  if callable(x):
+    who = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+    u = resource.getrusage(who)
+    out = x()
+    self_prof_add(x.__name__, t, u, resource.getrusage(who))
+    return 0, out
+  p = subprocess.Popen(x, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+  out = p.stdout.read()
+  p.stdout.close()
+  _, status, u = os.wait4(p.pid, 0) # reaps it with its own usage, as other tasks may run in parallel
+  p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+  self_prof_add(x, t, None, u)
+  return p.returncode, out
+
+def task_note(text):
+  class Done:
+    def wait(self): pass
+    def get(self): return 0, text
+  tasks['list'].append({'cmd': None, 'msg': None, 'needs': [], 'makes': [], 'verbose': False, 'result': Done()})
+
+# tasks_wait - wait for tasks that make any of needs, or all, showing outputs of the tasks done so far in order
+def tasks_wait(needs=None):
+  last = [i for i, t in enumerate(tasks['list']) if needs is None or set(t['makes']) & set(needs)]
+  if not len(last): return
+  done, tasks['list'] = tasks['list'][:last[-1] + 1], tasks['list'][last[-1] + 1:]
+  for t in done:
+    ret, out = t['result'].get()
+    with tasks['lock']:
+      if t['msg']: exe_v0(msg=t['msg'])
+      if t['verbose']: C.printc(t['cmd'], C.color.BLUE)
+      sys.stdout.write(out)
+      sys.stdout.flush()
+    if C.log_stdout:
+      with open(C.log_stdout, 'a') as f: f.write(out)
+    if ret: C.error("Command failed: " + t['cmd'].replace("\n", "\\n"))
+
+#
+# self-profile: wall & CPU time and peak RSS of every command run by do.py, in a JSON summary next to the .cmd file.
+# CPU and RSS are of the child processes; as the RSS of serial commands is only known as a maximum over all children
+# so far, it is reported where it grew. LBR analyses add phase counters of lbr.py (see LBR_PROFILE) under 'lbr'.
+#
+self_prof = {'file': None, 'steps': [], 'lbr': [], 'lock': threading.Lock(), 'cprofile': None}
+
+def self_prof_add(x, t, u0, u1):
+  if not self_prof['file']: return
+  cpu = u1.ru_utime + u1.ru_stime - (u0.ru_utime + u0.ru_stime if u0 else 0)
+  rss = u1.ru_maxrss if u0 is None or u1.ru_maxrss > u0.ru_maxrss else None
+  with self_prof['lock']:
+    self_prof['steps'].append({'cmd': x, 'wall': round(time.time() - t, 3), 'cpu': round(cpu, 3), 'max-rss-kb': rss})
+
+def self_prof_lbr(data):
+  if not self_prof['file']: return ''
+  self_prof['lbr'].append(data + '.lbr-profile.json')
+  return 'LBR_PROFILE=%s%s ' % (self_prof['lbr'][-1], ':cprofile' if self_prof['cprofile'] else '')
+
+def self_prof_end():
+  if self_prof['cprofile']:
+    self_prof['cprofile'].disable()
+    self_prof['cprofile'].dump_stats(self_prof['file'].replace('.json', '.prof'))
+  u = resource.getrusage(resource.RUSAGE_SELF)
+  summary = {'steps': self_prof['steps'], 'do.py': {'wall': round(time.time() - self_prof['start'], 3),
+    'cpu': round(u.ru_utime + u.ru_stime, 3), 'max-rss-kb': u.ru_maxrss}, 'lbr': {}}
+  for f in self_prof['lbr']:
+    if os.path.isfile(f):
+      with open(f) as j: summary['lbr'][f] = json.load(j)
+  with open(self_prof['file'], 'w') as j: json.dump(summary, j, indent=1)
+  C.info('wrote: %s' % self_prof['file'])
+
 def grep(x, f=''): return "(egrep '%s' %s || true)" % (x, f) # grep with 0 exit status
 
 def rp(x): return os.path.join(os.path.dirname(__file__), x)
 
+#
+# steps: collection runs of profile() are memoized in <app>.steps.json, keyed by a hash of the command (which embeds the
+# app and the do[] settings it depends on), the PMU and the perf version. A run whose outputs are intact is skipped, unless --force.
+#
+def step_key(x):
+  if not hasattr(step_key, 'perf'): step_key.perf = C.exe_output('%s --version 2>&1 || true' % args.perf, '')
+  return hashlib.sha1(json.dumps([x, pmu.desc(), step_key.perf], sort_keys=True).encode()).hexdigest()
+
+def step_stamp(f): return [os.path.getsize(f), int(os.path.getmtime(f))] if os.path.isfile(f) else None
+
+def steps_load(f):
+  try:
+    with open(f) as j: return json.load(j)
+  except (IOError, OSError, ValueError):
+    return {}
+
+def step_done(manifest, key, outs):
+  step = steps_load(manifest).get(key)
+  return step is not None and all(step_stamp(o) and step['outputs'].get(o) == step_stamp(o) for o in outs)
+
+def step_save(manifest, key, x, outs):
+  steps = steps_load(manifest)
+  steps[key] = {'cmd': x, 'outputs': {o: step_stamp(o) for o in outs}}
+  with open(manifest + '.tmp', 'w') as j: json.dump(steps, j, indent=1, sort_keys=True)
+  os.rename(manifest + '.tmp', manifest)
+
+#
+# steady_state: the time (in seconds) the first of n consecutive intervals starts at, whose IPC and instruction rate are
+# all within tolerance % of their medians over the second half of the run. None if the run never settles.
+#
+def steady_state(s, tolerance=5.0, n=5):
+  def total(event):
+    return [sum(v for v in vs if v == v) for vs in zip(*[s.series(e, c) for e, c in s.data
+                                                          if e.rstrip('/').split('/')[-1] == event])]
+  ins, cyc, t = total('instructions'), total('cycles'), [0.0] + list(s.times)
+  if len(ins) < 2 * n or len(cyc) != len(ins): return None
+  ipc = [i / c if c else 0.0 for i, c in zip(ins, cyc)]
+  rate = [i / (t[k + 1] - t[k]) if t[k + 1] > t[k] else 0.0 for k, i in enumerate(ins)]
+  def median(x): return sorted(x)[len(x) // 2]
+  refs = [(x, median(x[len(x) // 2:])) for x in (ipc, rate)]
+  def steady(k): return all(abs(x[k] - ref) * 100 <= tolerance * abs(ref) for x, ref in refs)
+  for k in range(len(ins) - n + 1):
+    if all(steady(j) for j in range(k, k + n)): return t[k]
+  return None
+
 def uniq_name():
   return C.command_basename(args.app_name, iterations=(args.app_iterations if args.gen_args else None))
 
@@ -227,7 +391,7 @@ def profile(log=False, out='run'):
     return power() if args.power and not pmu.v5p() else ''
   def perf_stat(flags='', events='', grep='| egrep "seconds [st]|CPUs|GHz|insn|topdown"'):
     def append(x, y): return x if y == '' else ','+x
-    perf_args = ' '.join((flags, do['perf-stat']))
+    perf_args = ' '.join((flags, do['perf-stat'], delay))
     if pmu.perfmetrics() and do['core']:
       prefix = ',topdown-'
       events += prefix.join([append('{slots', events),'retiring','bad-spec','fe-bound','be-bound'])
@@ -238,21 +402,85 @@ def profile(log=False, out='run'):
       grep = '' #keep output unfiltered with user-defined events
     if events != '': perf_args += ' -e "%s,%s"'%(do['perf-stat-def'], events)
     return '%s stat %s -- %s | tee %s.perf_stat%s.log %s'%(perf, perf_args, r, out, flags.strip(), grep)
-  def perf_script(x, msg):
-    return exe(' '.join((perf, 'script', x)), msg, redir_out=None, timeit=(args.verbose > 1))
+  def perf_script(x, msg, **kwargs):
+    return exe(' '.join((perf, 'script', x)), msg, redir_out=None, timeit=(args.verbose > 1), **kwargs)
+  def warmup():
+    # ms the app takes to settle, as set or detected off a cheap interval count of instructions & cycles
+    if do['warmup'] >= 0: return do['warmup']
+    log = '%s.warmup.csv' % out
+    collect('%s stat -I %d -x, -e instructions,cycles -o %s -- %s' % (perf, do['warmup-interval'], log, r),
+            'warm-up detection', [log])
+    if args.print_only or not os.path.isfile(log): return 0
+    t = steady_state(C.read_perf_stat_series(log), do['warmup-tolerance'])
+    if t is None: C.warn('no steady state found in %s; collecting all of the run' % log)
+    else: C.info('steady state reached after %.3f seconds' % t)
+    return int(1000 * t) if t else 0
+  def collect(x, msg, outs, **kwargs):
+    # a memoized collection run shows its outputs through the rest of its pipe, if any; returns whether it ran
+    key = step_key(x) if do['profile'] > 0 and not args.print_only else None
+    if key and not args.force and step_done(steps, key, outs):
+      rest = x.split('| tee %s' % outs[0], 1)
+      exe('cat %s%s' % (outs[0], rest[1]) if len(rest) > 1 else 'true', msg + ' (memoized)', **kwargs)
+      return False
+    # as a pipe's status is that of its last stage, the collector's own is kept aside
+    stage, rc = x.split(' | ', 1), steps + '.rc'
+    exe('(%s; echo $? > %s) | %s' % (stage[0], rc, stage[1]) if key and len(stage) > 1 else x, msg, **kwargs)
+    if key and len(stage) > 1:
+      ok = C.file2str(rc) == '0'
+      os.remove(rc)
+      if not ok:
+        C.warn('%s: collection failed, so it is not memoized' % msg)
+        return True
+    if key: step_save(steps, key, x, outs)
+    return True
+  def repeat_ci(x, log, metrics, msg):
+    # repeats a single run until the 95% confidence interval of every key metric is within do['repeat-ci'] % of
+    # its mean, or do['repeat-max'] runs, then reports the variance achieved. Topdown fractions may be near 0, so
+    # theirs is an absolute width, within do['repeat-ci'] percentage points, rather than one relative to the mean
+    def width(k, mean, ci):
+      if k not in ('time', 'IPC'): return ci
+      return 100 * ci / abs(mean) if mean else (float('inf') if ci else 0)
+    vals, cis = {}, {}
+    for n in range(1, do['repeat-max'] + 1):
+      exe(x, '%s, run %d' % (msg, n))
+      if args.print_only: return
+      for k, v in metrics(log).items(): vals.setdefault(k, []).append(v)
+      cis = {k: C.mean_ci(v) for k, v in vals.items()}
+      if n > 1 and (len(cis) or n >= do['repeat']) and \
+        all(width(k, mean, ci) <= do['repeat-ci'] for k, (mean, ci, sd) in cis.items()): break
+    ci_log = log.replace('.log', '-ci.log')
+    with open(ci_log, 'w') as f:
+      for k in sorted(cis):
+        mean, ci, sd = cis[k]
+        f.write('%-24s %14.4g +-%7.2f%-2s stddev: %-10.4g runs: %d\n' % (k, mean, width(k, mean, ci),
+                '%' if k in ('time', 'IPC') else 'pp', sd, len(vals[k])))
+    exe('cat ' + ci_log, '@variance after %d runs (95%% confidence intervals)' % n)
+  # LBR profiles are decoded once, into a cache all consumers stream from; see pscript
+  def pscript(data, what='text', comm=None): return ' '.join((rp('pscript'), data, what, comm or '-', perf))
+  def perf_decode(data):
+    exe(pscript(data, 'decode'), '@decoding %s' % data, redir_out=None, timeit=(args.verbose > 1), needs=[data],
+        makes=[lbr.script_path(data)])
   def record_name(flags):
     return '%s%s'%(out, C.chop(flags, (' :/,=', 'cpu_core', 'cpu')))
   
   perf_stat_log = "%s.perf_stat.log"%out
+  steps = '%s.steps.json' % out
   perf_report = ' '.join((perf, 'report', '--objdump %s'%do['objdump'] if os.path.isfile(do['objdump']) else ''))
   sort2u = 'sort | uniq -c | sort -n'
-  sort2up = sort2u + ' | %s'%rp('ptage')
+  sort2up = sort2u + ' | %s'%rp('ptage') if not do['ptage-top'] else '%s top %d' % (rp('ptage'), do['ptage-top'])
   r = do['run']
   if en(0) or log: log_setup()
+  delay = warmup() if do['warmup'] else 0
+  if do['window']: r = 'timeout -s INT %.3f %s' % ((delay + do['window']) / 1000.0, r)
+  delay = '-D %d' % delay if delay else ''
   
-  if en(1): exe(perf_stat(flags='-r%d' % do['repeat']), 'per-app counting %d runs' % do['repeat'])
+  if en(1) and do['repeat-ci']:
+    repeat_ci(perf_stat(flags='-r1'), '%s.perf_stat-r1.log' % out, results.stat_metrics, 'per-app counting')
+  elif en(1): collect(perf_stat(flags='-r%d' % do['repeat']), 'per-app counting %d runs' % do['repeat'],
+                      ['%s.perf_stat-r%d.log' % (out, do['repeat'])])
   
-  if en(2): exe(perf_stat('-a', a_events(), grep='| egrep "seconds|insn|topdown|pkg"'), 'system-wide counting')
+  if en(2): collect(perf_stat('-a', a_events(), grep='| egrep "seconds|insn|topdown|pkg"'), 'system-wide counting',
+                    ['%s.perf_stat-a.log' % out])
   
   if en(3) and do['sample']:
     base = out+'.perf'
@@ -260,21 +488,23 @@ def profile(log=False, out='run'):
       do['perf-record'] += ' '
       base += C.chop(do['perf-record'], ' :/,=')
     data = '%s.perf.data'%record_name(do['perf-record'])
-    exe(perf + ' record -c 1000003 -g -o %s '%data+do['perf-record']+r, 'sampling %sw/ stacks'%do['perf-record'])
+    collect(perf + ' record -c 1000003 -g -o %s %s '%(data, delay)+do['perf-record']+r, 'sampling %sw/ stacks'%do['perf-record'], [data])
     print_cmd("Try '%s -i %s' to browse time-consuming sources"%(perf_report, data))
-    #TODO:speed: parallelize next 3 exe() invocations & resume once all are done
+    code = base + '-code.log'
     exe(perf_report + " --stdio -F sample,overhead,comm,dso,sym -n --no-call-graph -i %s " \
       " | tee %s-funcs.log | grep -A7 Overhead | egrep -v '^# \.|^\s+$|^$' | head | sed 's/[ \\t]*$//'" %
-      (data, base), '@report functions')
+      (data, base), '@report functions', needs=[data], makes=[base + '-funcs.log'])
     exe(perf_report + " --stdio --hierarchy --header -i %s | grep -v ' 0\.0.%%' | tee "%data+
-      base+"-modules.log | grep -A22 Overhead", '@report modules')
-    exe(perf + " annotate --stdio -n -l -i %s | c++filt | tee %s-code.log " \
+      base+"-modules.log | grep -A22 Overhead", '@report modules', needs=[data], makes=[base + '-modules.log'])
+    exe(perf + " annotate --stdio -n -l -i %s | c++filt | tee %s " \
       "| egrep -v -E '^(\-|\s+([A-Za-z:]|[0-9] :))' > %s-code_nz.log" %
-      (data, base, base), '@annotate code', redir_out='2>/dev/null')
-    hottest = C.exe_one_line("sort -n %s-code.log | tail -1" % base, 0)
-    exe("egrep -w -5 '%s :' %s-code.log" % (hottest, base), '@hottest block')
+      (data, code, base), '@annotate code', redir_out='2>/dev/null', needs=[data], makes=[code, base + '-code_nz.log'])
     if do['xed']: perf_script("-i %s -F insn --xed | %s " \
-      "| tee %s-hot-insts.log | tail"%(data, sort2up, base), '@time-consuming instructions')
+      "| tee %s-hot-insts.log | tail"%(data, sort2up, base), '@time-consuming instructions', needs=[data],
+      makes=[base + '-hot-insts.log'])
+    tasks_wait([code])
+    hottest = C.exe_one_line("sort -n %s | tail -1" % code, 0)
+    exe("egrep -w -5 '%s :' %s" % (hottest, code), '@hottest block', needs=[code])
   
   toplev = '' if perf == 'perf' else 'PERF=%s '%perf
   toplev+= (args.pmu_tools + '/toplev.py --no-desc')
@@ -285,108 +515,228 @@ def profile(log=False, out='run'):
   if args.verbose < 2: grep_nz = grep_nz.replace('##placeholder##', ' < [\[\+]|<$')
   def toplev_V(v, tag='', nodes=do['nodes'], tlargs=args.toplev_args):
     o = '%s.toplev%s.log'%(out, v.split()[0]+tag)
-    return "%s %s --nodes '%s' -V %s %s -- %s"%(toplev, v, nodes,
-              o.replace('.log', '-perf.csv'), tlargs, r), o
+    return "%s %s --nodes '%s' -V %s %s %s -- %s"%(toplev, v, nodes,
+              o.replace('.log', '-perf.csv'), tlargs, delay, r), o
   
   cmd, log = toplev_V(do['toplev-full'])
-  if en(4): exe(cmd + ' | tee %s | %s'%(log, grep_bk), 'topdown full')
+  if en(4): collect(cmd + ' | tee %s | %s'%(log, grep_bk), 'topdown full', [log])
   
+  if en(5) and do['repeat-ci']:
+    cmd, log = toplev_V('-vl%d'%do['toplev-levels'], tlargs=args.toplev_args+' -r1')
+    repeat_ci(cmd + ' | tee %s | %s' % (log, grep_nz), log, results.toplev_metrics, 'topdown %d-levels' % do['toplev-levels'])
   cmd, log = toplev_V('-vl%d'%do['toplev-levels'], tlargs=args.toplev_args+' -r%d' % do['repeat'])
-  if en(5): exe(cmd + ' | tee %s | %s' % (log, grep_nz),
-              'topdown %d-levels %d runs' % (do['toplev-levels'], do['repeat']))
+  if en(5) and not do['repeat-ci']: collect(cmd + ' | tee %s | %s' % (log, grep_nz),
+                    'topdown %d-levels %d runs' % (do['toplev-levels'], do['repeat']), [log])
   
   if en(6):
     cmd, log = toplev_V('--drilldown --show-sample -l1', nodes='+IPC,+Heavy_Operations,+Time',
       tlargs='' if args.toplev_args == TOPLEV_DEF else args.toplev_args)
-    exe(cmd + ' | tee %s | egrep -v "^(Run toplev|Add|Using|Sampling|perf record)" '%log, 'topdown auto-drilldown')
+    collect(cmd + ' | tee %s | egrep -v "^(Run toplev|Add|Using|Sampling|perf record)" '%log, 'topdown auto-drilldown', [log])
     if do['sample'] > 3:
       cmd = C.exe_output("grep 'perf record' %s | tail -1"%log)
-      exe(cmd, '@sampling on bottleneck')
       perf_data = cmd.split('-o ')[1].split(' ')[0]
+      collect(cmd, '@sampling on bottleneck', [perf_data])
       print_cmd("Try '%s -i %s' to browse sources for critical bottlenecks"%(perf_report, perf_data))
       for c in ('report', 'annotate'):
         exe("%s %s --stdio -i %s > %s "%(perf, c, perf_data, log.replace('toplev--drilldown', 'locate-'+c)), '@'+c)
 
   if en(7) and args.no_multiplex:
     cmd, log = toplev_V(do['toplev-full']+' --no-multiplex', '-nomux', do['nodes'] + ',' + do['extra-metrics'])
-    exe(cmd + " | tee %s | %s"%(log, grep_nz)
+    collect(cmd + " | tee %s | %s"%(log, grep_nz)
       #'| grep ' + ('RUN ' if args.verbose > 1 else 'Using ') + out +# toplev misses stdout.flush() as of now :(
-      , 'topdown full no multiplexing')
+      , 'topdown full no multiplexing', [log])
     print_cmd("cat %s | %s"%(log, grep_NZ), False)
   
   data, comm = None, None
   def perf_record(tag, comm):
     assert '-b' in do['perf-%s'%tag] or '-j any' in do['perf-%s'%tag] or do['forgive'], 'No unfiltered LBRs! tag=%s'%tag
     perf_data = '%s.perf.data'%record_name(do['perf-%s'%tag])
-    if do['profile'] > 0: exe(perf + ' record %s -o %s %s -- %s'%(
-      do['perf-%s'%tag], perf_data, do['perf-stat-ipc'], r), 'sampling w/ '+tag.upper())
+    if do['profile'] > 0 and collect(perf + ' record %s %s -o %s %s -- %s'%(
+      do['perf-%s'%tag], delay, perf_data, do['perf-stat-ipc'], r), 'sampling w/ '+tag.upper(), [perf_data]) \
+      and not args.print_only: pmu.desc_save(perf_data + '.pmu.json')
     print_cmd("Try '%s -i %s --branch-history --samples 9' to browse streams"%(perf_report, perf_data))
+    print_cmd("Try 'PMU_DESC=%s.pmu.json ./lbr_stats' to analyze its LBRs on another machine" % perf_data, False)
     if not comm:
-      # might be doable to optimize out this 'perf script' with 'perf buildid-list' e.g.
-      comm = C.exe_one_line(perf + " script -i %s -F comm | %s | tail -1"%(perf_data, sort2u), 1)
+      comm = C.exe_one_line("%s | %s | tail -1" % (pscript(perf_data, 'comm'), sort2u), 1)
     return perf_data, comm
   
-  if en(8) and do['sample'] > 1:
+  def lbr_script(data, comm, tool, msg, **kwargs):
+    # replay tokenized LBRs from a cache if a previous pass left one behind
+    spec = '%s:%s' % (data, comm) if comm else data
+    if lbr.cache_valid(spec): exe('LBR_CACHE=%s %s < /dev/null' % (spec, tool), msg, redir_out=None, **kwargs)
+    else: exe('%s | LBR_CACHE=%s %s' % (pscript(data, 'text', comm), spec, tool), msg, redir_out=None, **kwargs)
+  
+  def lbr_stats(data, argss, log, msg):
+    # lbr_stats analyses in-process, all sharing a single pass over the (cached) LBR samples; they hold lbr.Active
+    # per sample, so they are safe on a task thread. Step 8 runs lbr_stats as a process instead, sharing its pass with
+    # imix, and so it honors LBR_SAMPLE and LBR_PROFILE
+    script = pscript(data)
+    for a in argss: print_cmd("%s | %s %s | tee -a %s" % (script, rp('lbr_stats'), a, log), False)
+    def run():
+      writer = None
+      if lbr.cache_valid(data): lines = lbr.cache_lines(lbr.cache_path(data)[1])
+      else:
+        lines = lbr.script_lines(data, perf=perf)
+        if sys.version_info[0] > 2: writer = lbr.CacheWriter(data)
+      analyzers = [lbr.LbrStats(a.split()) for a in argss]
+      lbr.analyze(analyzers, lines, writer)
+      report = StringIO()
+      with open(log, 'a') as f:
+        class Tee:
+          def write(self, x): report.write(x); f.write(x)
+          def flush(self): f.flush()
+        with tasks['lock']:
+          stdout, sys.stdout = sys.stdout, Tee()
+          try:
+            for a in analyzers: a.report()
+          finally: sys.stdout = stdout
+      return report.getvalue()
+    task(run, msg, [data, lbr.script_path(data), log], [log])
+  
+  # collection runs go first, so that post-processing of LBR and PEBS profiles may overlap
+  lbr_en, pebs_en = en(8) and do['sample'] > 1, en(9) and do['sample'] > 2
+  if lbr_en:
     assert pmu.lbr_event()[:-1] in do['perf-lbr'], 'Incorrect event for LBR in: '+do['perf-lbr']
     data, comm = perf_record('lbr', comm)
+    lbr_data = data
+  if pebs_en: pebs_data, comm = perf_record('pebs', comm)
+  
+  if lbr_en:
     info = '%s.info.log'%data
-    exe(perf +" report -i %s | grep -A11 'Branch Statistics:' | tee %s"%(data, info), "@stats")
+    exe(perf +" report -i %s | grep -A11 'Branch Statistics:' | tee %s"%(data, info), "@stats", needs=[data], makes=[info])
     if os.path.isfile(perf_stat_log):
-      exe("egrep '  branches|instructions' %s >> %s"%(perf_stat_log, info))
+      exe("egrep '  branches|instructions' %s >> %s"%(perf_stat_log, info), needs=[info], makes=[info])
     if do['xed']:
       ips = '%s.ips.log'%data
       hits = '%s.hitcounts.log'%data
-      exe_v0('printf "\n# LBR-based Statistics:\n#\n">> %s'%info)
+      imix = ['%s.perf-imix%s.log' % (out, x) for x in ('', '-no')]
+      exe('printf "\n# LBR-based Statistics:\n#\n">> %s'%info, redir_out=None, needs=[info], makes=[info])
       print_cmd(perf + " script -i %s -F +brstackinsn --xed -c %s "
         "| %s %s" % (data, comm, './lbr_stats', do['lbr-stats-tk']))
-      perf_script("-i %s -F +brstackinsn --xed -c %s "
-        "| tee >(LBR_LOOPS_LOG=%s.loops.log %s %s >> %s) | egrep '^\s[0f7]' | sed 's/#.*//;s/^\s*//;s/\s*$//' "
-        "| tee >(sort|uniq -c|sort -k2 | tee %s | cut -f-2 | sort -nu | %s > %s) | cut -f4- "
-        "| tee >(cut -d' ' -f1 | %s > %s.perf-imix-no.log) | %s | tee %s.perf-imix.log | tail" %
-        (data, comm, data, rp('lbr_stats'), do['lbr-stats-tk'], info, hits, rp('ptage'), ips,
-        sort2up, out, sort2up, out), "@instruction-mix for '%s'"%comm)
-      exe("tail %s.perf-imix-no.log"%out, "@i-mix no operands for '%s'"%comm)
-      exe("tail -4 "+ips, "@top-3 hitcounts of basic-blocks to examine in "+hits)
-      exe("%s && tail %s" % (grep('code footprint', info), info), "@hottest loops & more stats in " + info)
-      if do['loops']:
-        prn_line(info)
-        cmd, top = '', do['loops']
-        while top > 1:
-          cmd += ' | tee >(%s %s >> %s) ' % (rp('loop_stats'),
-            C.exe_one_line('tail -%d %s.loops.log | head -1' % (top, data), 2)[:-1], info)
-          top -= 1
-        cmd += ' | %s %s >> %s' % (rp('loop_stats'), C.exe_one_line('tail -1 %s.loops.log' % data, 2)[:-1], info)
-        perf_script("-i %s -F +brstackinsn --xed -c %s %s" % (data, comm, cmd), "@stats for top %d loops" % do['loops'])
+      perf_decode(data)
+      exe("%s | tee >(%s%sLBR_CACHE=%s:%s LBR_LOOPS_LOG=%s.loops.log %s %s >> %s) | %s %s %s %s" %
+        (pscript(data, 'text', comm), 'LBR_SAMPLE=%s ' % do['lbr-sample'] if do['lbr-sample'] else '', self_prof_lbr(data),
+        data, comm, data,
+        rp('lbr_stats'), do['lbr-stats-tk'], info, rp('imix'), hits, ips, out), "@instruction-mix for '%s'"%comm,
+        redir_out=None, timeit=(args.verbose > 1), needs=[lbr.script_path(data), info], makes=[info, ips, hits, data + '.loops.log'] + imix)
+      exe("tail %s"%imix[1], "@i-mix no operands for '%s'"%comm, needs=imix)
+      exe("tail -4 "+ips, "@top-3 hitcounts of basic-blocks to examine in "+hits, needs=[ips])
+      exe("%s && tail %s" % (grep('code footprint', info), info), "@hottest loops & more stats in " + info, needs=[info])
   
-  if en(9) and do['sample'] > 2:
-    data, comm = perf_record('pebs', comm)
+  if pebs_en:
+    data = pebs_data
+    ips = '%s.ips.log'%data
     exe(perf + " report -i %s --stdio -F overhead,comm,dso | tee %s.modules.log | grep -A12 Overhead" %
-      (data, data), "@ top-10 modules")
-    perf_script("-i %s -F ip | %s | tee %s.ips.log | tail -11"%(data, sort2up, data), "@ top-10 IPs")
+      (data, data), "@ top-10 modules", needs=[data], makes=[data + '.modules.log'])
+    perf_decode(data)
+    exe("%s | %s | tee %s | tail -11" % (pscript(data, 'ip'), sort2up, ips), "@ top-10 IPs", redir_out=None,
+        needs=[lbr.script_path(data)], makes=[ips])
     is_dsb = 0
     if pmu.dsb_msb() and 'DSB_MISS' in do['perf-pebs']:
       if pmu.cpu('smt-on'): C.warn('Disable SMT for DSB robust analysis')
-      else:
-        is_dsb = 1
-        perf_script("-i %s -F ip | %s %d 6 | %s | tee %s.dsb-sets.log | tail -11" %
-                    (data, rp('addrbits'), pmu.dsb_msb(), sort2up, data), "@ DSB-miss sets")
+      else: is_dsb = 1
+    ranges = ','.join(x for x in ('dsb' if is_dsb else '', do['addr-hist']) if x)
+    if ranges:
+      # a single pass buckets IPs by all address-bit ranges
+      hist = '%s.addr-hist.log' % data
+      exe("%s | %s hist %s | tee %s | grep '^#'" % (pscript(data, 'ip'), rp('addrbits'), ranges, hist),
+          "@ address-bits histograms", redir_out=None, needs=[lbr.script_path(data)], makes=[hist])
+    if is_dsb:
+      exe("sed -n '/^# dsb/,/===total/p' %s | tee %s.dsb-sets.log | tail -11" % (hist, data), "@ DSB-miss sets",
+          redir_out=None, needs=[hist], makes=[data + '.dsb-sets.log'])
     top = 0
-    if not is_dsb: pass
-    elif top == 1:
-      top_ip = C.exe_one_line("tail -2 %s.ips.log | head -1"%data, 2)
-      perf_script("-i %s -F +brstackinsn --xed "
-        "| tee >(%s %s | tee -a %s.ips.log) " # asserts in skip_sample() only if piped!!
-        "| %s %s | tee -a %s.ips.log"%(data, rp('lbr_stats'), top_ip, data,
-            rp('lbr_stats'), do['lbr-stats'], data), "@ stats on PEBS event")
-    else:
-      perf_script("-i %s -F +brstackinsn --xed "
-        "| %s %s | tee -a %s.ips.log"%(data, rp('lbr_stats'), do['lbr-stats'], data), "@ stats on PEBS event")
-    if top > 1:
-      while top > 0:
-        top_ip = C.exe_one_line("egrep '^[0-9]' %s.ips.log | tail -%d | head -1"%(data, top+1), 2)
-        perf_script("-i %s -F +brstackinsn --xed "
-          "| %s %s | tee -a %s.ips.log"%(data, rp('lbr_stats'), top_ip, data), "@ stats on PEBS ip=%s"%top_ip)
-        top -= 1
+    if is_dsb:
+      if top: tasks_wait([ips])
+      top_ips = [C.exe_one_line("egrep '^[0-9]' %s | tail -%d | head -1"%(ips, t+1), 2) for t in range(top, 0, -1)]
+      lbr_stats(data, [do['lbr-stats']] + top_ips, ips,
+        "@ stats on PEBS event%s" % (' & ip=' + ','.join(top_ips) if top else ''))
+  
+  if lbr_en and do['xed'] and do['loops']:
+    data = lbr_data
+    loops_log = '%s.loops.log' % data
+    tasks_wait([loops_log])
+    exe('echo >> %s' % info, redir_out=None, needs=[info], makes=[info])
+    # all top loops are handled in a single pass, hottest first
+    loops = C.exe2list("tail -%d %s | tac | cut -d' ' -f3 | tr -d ," % (do['loops'], loops_log))
+    if len(loops[0]): lbr_script(data, comm, "%s %s >> %s" % (rp('loop_stats'), ','.join(loops), info),
+      "@stats for top %d loops" % len(loops), needs=[data, info], makes=[info])
+  tasks_wait()
+  if do['results-db'] and not args.print_only: results.add(do['results-db'], out, C.argv2str(), r, do['pmu'])
+
+# results_cmd - results-<cmd>[:<arg>,..] queries the results database, e.g. results-diff:<run1>,<run2>; see results.py
+def results_cmd(c):
+  cmd, a = c.split(':', 1) if ':' in c else (c, '')
+  a = a.split(',') if a else []
+  cmd = cmd.replace('results-', '')
+  if cmd == 'add': results.add(do['results-db'], *(a or [uniq_name()]))
+  elif cmd == 'runs': results.runs(do['results-db'], *a)
+  elif cmd == 'show': results.show(do['results-db'], *a)
+  elif cmd == 'diff': results.diff(do['results-db'], *a[:3] + [float(x) for x in a[3:4]])
+  elif cmd == 'query': results.query(do['results-db'], *a)
+  else: C.error("Unknown results command: '%s'" % c)
+
+#
+# batch: profile the workloads of a manifest, several at once, each confined to a physical core of its own: its do.py,
+# with the perf, toplev and post-processing it runs, are pinned to the SMT siblings of that core. Isolated CPUs
+# (isolcpus=) are used if any, otherwise all cores but that of CPU 0. Commands are as of an unpinned run, so steps
+# memoized by one are reused by the other.
+# Manifest lines are app commands, optionally followed by ';;' and do.py options for that app; '#' starts a comment.
+#
+def cpu_list(s): # e.g. 0-3,8
+  cpus = []
+  for x in (s or '').split(','):
+    if x.strip():
+      x = x.split('-')
+      cpus += range(int(x[0]), int(x[-1]) + 1)
+  return cpus
+
+def batch_cpus(sysfs='/sys/devices/system/cpu/'):
+  def read(f): return C.file2str(f) if os.path.isfile(f) else ''
+  cpus = cpu_list(read(sysfs + 'online'))
+  if os.path.isfile('/sys/devices/cpu_core/cpus'): # hybrid: big cores only
+    cpus = [c for c in cpus if c in cpu_list(read('/sys/devices/cpu_core/cpus'))]
+  cores = {}
+  for c in cpus:
+    t = '%scpu%d/topology/' % (sysfs, c)
+    cores.setdefault((read(t + 'physical_package_id'), read(t + 'core_id')), []).append(c)
+  isolated = set(cpu_list(read(sysfs + 'isolated')))
+  if len(isolated): cores = {k: v for k, v in cores.items() if set(v) <= isolated}
+  elif len(cores) > 1: cores = {k: v for k, v in cores.items() if 0 not in v}
+  return sorted(sorted(v) for v in cores.values())
+
+def batch(manifest):
+  jobs = []
+  for line in C.file2lines(manifest, fail=True):
+    line = line.split('#')[0].strip()
+    if line: jobs.append([x.strip() for x in (line.split(';;', 1) + [''])[:2]])
+  names = [C.command_basename(app) for app, o in jobs]
+  for n in set(names):
+    if names.count(n) > 1: C.error("batch: workloads of '%s' in %s would share their logs" % (n, manifest))
+  cores = batch_cpus()
+  if not len(cores): C.error('batch: no CPUs to run on')
+  if args.profile_mask & 1: log_setup()
+  # options of this run pass to all jobs, less setup logging and system-wide steps that would see them all
+  opts = ' '.join(quote(x) for x in sys.argv[1:] if x not in args.command)
+  opts += ' -pm %x' % (args.profile_mask & ~0x5)
+  free = Queue()
+  for c in cores: free.put(','.join(str(x) for x in c))
+  def job(app, o, name):
+    def run():
+      c = free.get()
+      x = 'taskset -c %s %s profile %s %s -a %s > %s-batch.log 2>&1' % (c, rp('do.py'), opts, o, quote(app), name)
+      ret = subprocess.call(x, shell=True)
+      free.put(c)
+      return '%s on CPUs %s: %s\n' % (name, c, 'failed, see %s-batch.log' % name if ret else 'done')
+    run.__name__ = 'batch-' + name
+    return run
+  C.info('batch: %d workloads on cores of CPUs %s' % (len(jobs), ' '.join(','.join(str(x) for x in c) for c in cores)))
+  tasks_wait()
+  pool, tasks['pool'] = tasks['pool'], ThreadPool(len(cores))
+  for (app, o), name in zip(jobs, names):
+    print_cmd('%s profile %s %s -a %s' % (rp('do.py'), opts, o, quote(app)), False)
+    task(job(app, o, name), '@batch: ' + name, makes=[name + '-batch.log'])
+  tasks_wait()
+  tasks['pool'] = pool
 
 def do_logs(cmd, ext=[], tag=''):
   log_files = ['', '.cmd', 'csv', 'log', 'txt'] + ext
@@ -407,13 +757,19 @@ def build_kernel(dir='./kernels/'):
 
 def parse_args():
   ap = argparse.ArgumentParser(usage='do.py command [command ..] [options]', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-  ap.add_argument('command', nargs='+', help='setup-perf log profile tar, all (for these 4) '\
+  ap.add_argument('command', nargs='+', help='setup-perf log profile tar, all (for these 4), results-add|runs|show|diff|query[:args] '\
+                  'batch[:manifest] '\
                   '\nsupported options: ' + C.commands_list())
   ap.add_argument('--perf', default='perf', help='use a custom perf tool')
   ap.add_argument('--pmu-tools', default='%s ./pmu-tools'%do['python'], help='use a custom pmu-tools')
   ap.add_argument('--toplev-args', default=do['toplev'], help='arguments to pass-through to toplev')
   ap.add_argument('--install-perf', nargs='?', default=None, const='install', help='perf tool installation options: [install]|patch|build')
   ap.add_argument('--print-only', action='store_const', const=True, default=False, help='print the commands without running them')
+  ap.add_argument('--self-profile', nargs='?', const='json', choices=('json', 'cprofile'), default=None,
+                  help='summarize wall/CPU time & peak RSS of each command, and LBR analysis phases, as JSON next to the .cmd file; '
+                  'cprofile adds cProfile dumps')
+  ap.add_argument('--force', action='store_const', const=True, default=False,
+                  help='re-collect profile steps whose outputs of an identical earlier run are intact')
   ap.add_argument('-m', '--metrics', default=do['metrics'], help='user metrics to pass to toplev\'s --nodes')
   ap.add_argument('-e', '--events', help='user events to pass to perf-stat\'s -e')
   ap.add_argument('--power', action='store_const', const=True, default=False, help='collect power metrics/events as well')
@@ -438,6 +794,7 @@ def main():
     C.error('must specify --app-name with any of: --gen-args, build')
   assert not (args.print_only and (args.profile_mask & 0x300)), 'No print-only + lbr/pebs profile-steps'
   assert args.sys_wide >= 0, 'negative duration provided!'
+  assert not (args.app_name and [c for c in args.command if c.startswith('batch')]), 'batch takes apps from its manifest, not --app-name'
   if args.verbose > 4: args.toplev_args += ' -g'
   if args.verbose > 2: args.toplev_args += ' --perf'
   if args.verbose > 1: args.toplev_args += ' -v'
@@ -466,6 +823,12 @@ def main():
     exe_v0('mv %s %s-%d.cmd' % (cmds_file, cmds_file.replace('.cmd', ''), os.getpid()))
   do['cmds_file'] = open(cmds_file, 'w')
   do['cmds_file'].write('# %s\n' % do_cmd)
+  if args.self_profile:
+    self_prof.update(file=cmds_file.replace('.cmd', '.self-profile.json'), start=time.time())
+    if args.self_profile == 'cprofile':
+      import cProfile
+      self_prof['cprofile'] = cProfile.Profile()
+      self_prof['cprofile'].enable()
   if args.verbose > 3: C.printc(str(args))
   
   for c in args.command:
@@ -493,6 +856,8 @@ def main():
     elif c == 'log':          log_setup()
     elif c == 'profile':      profile()
     elif c == 'tar':          do_logs(c)
+    elif c.startswith('results-'): results_cmd(c)
+    elif c.startswith('batch'): batch(c.split(':', 1)[1] if ':' in c else 'batch.txt')
     elif c == 'clean':        do_logs(c)
     elif c == 'all':
       setup_perf()
@@ -507,4 +872,5 @@ def main():
 if __name__ == "__main__":
   main()
   do['cmds_file'].close()
+  if self_prof['file']: self_prof_end()
 
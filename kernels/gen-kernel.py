@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # generate C-language kernels with ability to incorporate x86 Assembly with certain control-flow constructs
 # Author: Ahmad Yasin
-# edited: April 2022
+# edited: Oct. 2026
 from __future__ import print_function
 __author__ = 'ayasin'
 __version__ = 0.8
@@ -33,10 +33,15 @@ ap.add_argument('--label-prefix', default='Lbl', help="Starting '@' implies loca
 ap.add_argument('mode', nargs='?', choices=['basicblock']+J.jumpy_modes, default='basicblock')
 ap.add_argument('--mode-args', default='', help="args to pass-through to mode's sub-module")
 ap.add_argument('--reference', default=None, help="ID of a reference paper (prints a message)")
+ap.add_argument('--asm', action='store_true', help="emit a plain .S assembly file rather than C with inline asm")
 args = ap.parse_args()
 
 def jumpy(): return args.mode in J.jumpy_modes
 
+# output is buffered, as huge kernels have millions of lines
+out = os.fdopen(sys.stdout.fileno(), 'w', 1 << 20)
+def emit(x): out.write(x + '\n')
+
 def error(x):
   C.printf(x)
   sys.exit(' !\n')
@@ -67,9 +72,8 @@ def itemize(insts):
   return out
 
 def asm(x, tabs=1, spaces=8+4*(args.loops-1)):
-  if ';' in x:
-    for i in x.split(';'): print(x86_asm(i, tabs, spaces))
-  else: print(x86_asm(x, tabs, spaces))
+  for i in x.split(';') if ';' in x else [x]:
+    emit(' '*spaces + '\t'*tabs + x86_inst(i) if args.asm else x86_asm(i, tabs, spaces))
 
 def label(n, declaration=True, local=False):
  lbl = '%s%05d'%(args.label_prefix, n) if isinstance(n, int) else n
@@ -77,19 +81,43 @@ def label(n, declaration=True, local=False):
    local = True
    lbl = '%s%05d'%(args.label_prefix[1:], n)
  if declaration:
-   if local: return '.local %s\\n"\n\t    "%s:'%(lbl, lbl)
+   if local: return ('.local %s; %s:' if args.asm else '.local %s\\n"\n\t    "%s:')%(lbl, lbl)
    else:     return lbl+':'
  else:
    return ' '+lbl
 
 
 #kernel's Header
-print("""// Auto-generated by %s's %s version %s invoked with:
+emit("""// Auto-generated by %s's %s version %s invoked with:
 // %s
 // Do not modify!
 //
-%s
-#include <stdint.h>
+%s"""%(__author__, C.arg(0), str(__version__), str(args).replace('Namespace', ''),
+  '/* %s\n */'%references.Comments[args.reference].replace('\n', '\n * ') if args.reference else ''))
+if args.asm: emit("""    .text
+    .globl main
+    .type main, @function
+main:
+    push %%rbp
+    mov %%rsp, %%rbp
+    sub $%d, %%rsp
+    mov %%rsi, -8(%%rbp)
+    cmp $2, %%edi
+    jge .Lstart
+    mov (%%rsi), %%rsi
+    lea .Lusage(%%rip), %%rdi
+    xor %%eax, %%eax
+    call printf@PLT
+    mov $-1, %%edi
+    call exit@PLT
+.Lstart:%s
+    mov -8(%%rbp), %%rsi
+    mov 8(%%rsi), %%rdi
+    call atol@PLT
+    mov %%rax, %%r10"""%(16 * ((args.loops + 2) // 2), """
+    lea .Lmsg(%rip), %rdi
+    call puts@PLT""" if args.reference else ''))
+else: emit("""#include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 
@@ -104,17 +132,21 @@ int main(int argc, const char* argv[])
         exit(-1);
     }
     if (MSG) printf("%%s\\n", MSG ? MSG : "");
-    n= atol(argv[1]);"""%(__author__, C.arg(0), str(__version__), str(args).replace('Namespace', ''),
-  '/* %s\n */'%references.Comments[args.reference].replace('\n', '\n * ') if args.reference else '', paper))
+    n= atol(argv[1]);"""%paper)
 for x in vars(args).keys():
   if 'instructions' in x:
     setattr(args, x, itemize(getattr(args, x)))
 for inst in [INST_UNIQ] + args.prolog_instructions: asm(inst, spaces=4)
 
+# in .S, loop counters are: n in r10, i0 in r9, others on the stack
+def counter(l): return '%r9' if l == 0 else '-%d(%%rbp)'%(8*(l+1))
+
 #kernel's Body
 for l in range(args.loops):
+  if args.asm: asm('movq $0, %s;cmp %%r10, %s;jae .Ldone%d'%(counter(l), counter(l), l), spaces=4*(l+1))
   if l == args.loops-1 and args.align: asm('.align %d'%(2 ** args.align), tabs=0, spaces=8+4*l)
-  print(' '*4*(l+1) + 'for (' + ('' if l==0 else 'uint64_t ') + '%s=0; %s<n; %s++) {' % (('i%d'%l,)*3))
+  if args.asm: asm('.Lfor%d:'%l, tabs=0, spaces=4*(l+1))
+  else: emit(' '*4*(l+1) + 'for (' + ('' if l==0 else 'uint64_t ') + '%s=0; %s<n; %s++) {' % (('i%d'%l,)*3))
 for j in range(args.unroll_factor):
   if args.offset:
      for k in range(j+args.offset-1): asm(INST_1B)
@@ -140,12 +172,26 @@ for j in range(args.unroll_factor):
   if jumpy() and args.align: asm('.align %d'%(2 ** args.align), tabs=0)
 if jumpy(): asm(label(args.unroll_factor), tabs=0)
 for l in range(args.loops, 0, -1):
-  print(' '*4*l + "}")
+  if args.asm:
+    asm('addq $1, %s;cmp %%r10, %s;jb .Lfor%d'%(counter(l-1), counter(l-1), l-1), spaces=4*l)
+    asm('.Ldone%d:'%(l-1), tabs=0, spaces=4*l)
+  else: emit(' '*4*l + "}")
 
 #kernel's Footer
 for inst in args.epilog_instructions: asm(inst, spaces=4)
-print("""    asm(".align 512; %s_end:");
+if args.asm: emit("""    .align 512; %s_end:
+    xor %%eax, %%eax
+    leave
+    ret
+    .size main, .-main
+    .section .rodata
+.Lusage:
+    .string "%%s: missing <num-iterations> arg!\\n"%s
+    .section .note.GNU-stack,"",@progbits"""%(args.label_prefix.replace('@', ''),
+  '\n.Lmsg:\n    .string %s'%paper if args.reference else ''))
+else: emit("""    asm(".align 512; %s_end:");
 
     return 0;
 }"""%args.label_prefix.replace('@', ''))
+out.flush()
 
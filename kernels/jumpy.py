@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 # Author: Ahmad Yasin
-# edited: Nov. 2021
+# edited: Oct. 2026
 from __future__ import print_function
 __author__ = 'ayasin'
 
@@ -32,69 +32,45 @@ def print_list(l):
     x=l[x]
   print('.')
 
+# random_chain - targets of n blocks, by block, that visit all in a random order starting at block 0, the last one
+# jumping out to n; in linear time, as a shuffle rather than a search for a single-cycle permutation. The first jump
+# goes neither to the next block nor to the last. pf_list has targets prefetch+1 jumps ahead, wrapping around to block 0.
+# Targets are numeric-label references if numbers, e.g. 7f or 3b
+def random_chain(n, prefetch=0, numbers=False):
+  if n < 4: C.error('jumpy-random: cannot converge with --num<4')
+  order = list(range(1, n))
+  random.shuffle(order)
+  order.insert(0, 0)
+  if order[1] in (1, n-1):
+    k = random.choice([i for i in range(2, n) if order[i] not in (1, n-1)])
+    order[1], order[k] = order[k], order[1]
+  targets, pf_list = [n] * n, [0] * n if prefetch else None
+  for i in range(n-1): targets[order[i]] = order[i+1]
+  if prefetch:
+    for i in range(n): pf_list[order[i]] = order[(i + prefetch + 1) % n]
+  if numbers:
+    def ref(l): return [str(t) + ('f' if t > x else 'b') for x, t in enumerate(l)]
+    targets, pf_list = ref(targets), pf_list and ref(pf_list)
+  return targets, pf_list
+
 def jumpy_idx(mode, n, prefetch):
   if mode == 'jumpy-seq':
     jumpy_idx.counter += 1
     return jumpy_idx.counter
   elif mode.startswith('jumpy-random'):
-    if jumpy_idx.counter == 0:
-      if n < 4: C.error('jumpy-random: cannot converge with --num<4')
-      done = False
-      visited_l = [0] * n
-      patch_list = [None] * n if flags['numbers-labels'] else None
-      if debug>1: print(visited_l)
-      step('// jump-random: trials ')
-      xx=n
-      trial=1
-      while not done:
-        jumpy_idx.list = random.sample(range(n), n)
-        while jumpy_idx.list[0] in [n-1, 1]:
-          if debug>3: print('list[0]=%d:'%jumpy_idx.list[0], jumpy_idx.list)
-          step()
-          jumpy_idx.list = random.sample(range(n), n)
-          trial += 1
-        visited_l = [0] * n
-        lookahead = None
-        if flags['prefetch']:
-          jumpy_idx.pf_list = [0] * n
-          lookahead = [jumpy_idx.list[jumpy_idx.list[0]]] * flags['prefetch']
-          for i in range(flags['prefetch'] - 1):
-            lookahead[i+1] = jumpy_idx.list[lookahead[i]]
-        done = True
-        if debug>2: print('while:', jumpy_idx.list)
-        x=0
-        r=0
-        while r < n:
-          if visited_l[x]:
-            done = False
-            if debug>3: print('cycle of r=%d!'%r)
-            break
-          visited_l[x]=1
-          xx = x
-          if lookahead:
-            if debug>1: print('lookahead:', lookahead)
-            jumpy_idx.pf_list[x] = lookahead[-1]
-            lookahead.append(jumpy_idx.list[lookahead[-1]])
-            lookahead.pop(0)
-          x = jumpy_idx.list[x]
-          if patch_list:
-            patch_list[xx] = str(x) + ('f' if x>xx else 'b')
-          r += 1
-        if debug>1 and done: print('done: xx=%d, r=%d!'%(xx, r))
-      jumpy_idx.list[xx] = n
+    if jumpy_idx.list is None:
+      jumpy_idx.list, jumpy_idx.pf_list = random_chain(n, flags['prefetch'], flags['numbers-labels'])
       if debug:
-        print("final:", jumpy_idx.list, jumpy_idx.pf_list, patch_list)
-        for l in (jumpy_idx.list, jumpy_idx.pf_list): print_list(l)
-      if patch_list:
-        patch_list[xx] = str(n)+'f'
-        jumpy_idx.list = patch_list
-      step('\n')
-      jumpy_idx.counter = -1
-    return jumpy_idx.pf_list.pop(0) if prefetch else jumpy_idx.list.pop(0)
+        print("final:", jumpy_idx.list, jumpy_idx.pf_list)
+        if not flags['numbers-labels']:
+          for l in (jumpy_idx.list, jumpy_idx.pf_list or []): print_list(l)
+    # the prefetch of a block precedes its jump
+    if prefetch: return jumpy_idx.pf_list[jumpy_idx.counter]
+    jumpy_idx.counter += 1
+    return jumpy_idx.list[jumpy_idx.counter - 1]
   else: C.error("jumpy_idx(): unsupported mode '%s'!"%mode)
 jumpy_idx.counter = 0
 jumpy_idx.list = None
-jumpy_idx.pf_counter = 0
 jumpy_idx.pf_list = None
 
 def next(prefetch=False):
@@ -48,9 +48,7 @@ def x86_inst(x):
     assert (':' in x),  "Expect :N in '%s'!"%x
     return x86_pad(int(x.split(':')[1]), 'NOP15')
   if ';' in x: return x # no support for chain of instructions
-  for a in aliases.keys():
-    if x == a: return aliases[a]
-  return x
+  return aliases.get(x, x)
 
 def x86_asm(x, tabs=1, spaces=8):
   return ' '*spaces + 'asm("' + '\t'*tabs + x86_inst(x) + '");'
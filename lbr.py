@@ -5,11 +5,14 @@
 #
 from __future__ import print_function
 __author__ = 'ayasin'
-__version__= 0.50
+__version__= 0.51
 
 import common as C
 import pmu
-import os, re, sys
+import binascii, bisect, itertools, math, os, random, re, sys, time
+import gzip, json, mmap, shutil, subprocess, threading
+from array import array
+from collections import namedtuple
 
 debug = os.getenv('DBG')
 verbose = os.getenv('VER')
@@ -28,219 +31,706 @@ def str2int(ip, plist):
   try:
     return int(ip, 16)
   except ValueError:
-    print_sample(plist[2])
+    if plist[1]: print_sample(plist[1])
     assert 0, "expect address in '%s' of '%s'" % (ip, plist[0])
 
 def skip_sample(s):
-  line = read_line()
-  while not re.match(r"^$", line):
-    line = read_line()
+  line = next_line()
+  while line and line.kind != EMPTY:
+    line = next_line()
     assert line, 'was input truncated? sample:\n%s'%s
   return 0
 
-def header_ip(line):
-  x = is_header(line)
-  assert x, "Not a head of sample: " + line
-  return str2int(C.str2list(line)[6 if '[' in x.group(1) else 5], (line, None))
-
-def line_ip(line, sample=None):
-  x = re.match(r"\s+(\S+)\s+(\S+)", line)
-  assert x, 'expect <address> at left of %s'%line
-  ip = x.group(1).lstrip("0")
-  return str2int(ip, (line, sample))
-
-def line_timing(line):
-  x = re.match(r"[^#]+# (\S+) (\d+) cycles \[\d+\] ([0-9\.]+) IPC", line)
-  assert x, 'Could not match IPC in:\n%s'%line
-  ipc = round(float(x.group(3)), 1)
-  cycles = int(x.group(2))
+# read_raw - lines of the next sample, as raw text unless a cache is on to avoid tokenizing; None once input ended
+def read_raw():
+  lines, cached = [], cache['in'] or cache['out']
+  while True:
+    x = next_line() if cached else read_line()
+    if not x: return lines or None
+    lines.append(x)
+    if (x.kind == EMPTY) if cached else x == '\n': return lines
+
+# A tokenized line of perf script -F +brstackinsn output. Fields by kind:
+#   INST:   ip, taken, cycles & ipc (of timed taken branches), mnemonic and attribute bits
+#   HEADER: ip of the sample while mnem holds the event name
+#   others: kind and text only
+Line = namedtuple('Line', 'kind ip taken cycles ipc mnem atts text')
+INST, HEADER, LABEL, EMPTY, UNREACHED, OTHER = range(6)
+
+# loop-body attributes: (tag, regex, bit)
+Attributes = tuple((a[0], re.compile(a[1]), 1 << i) for i, a in enumerate((
+  ('indirect',  r"(jmp|call)\s%"),
+  ('vec128-fp', r"p[sdh]\s+%xmm"),
+  ('vec256-fp', r"p[sdh]\s+%ymm"),
+  ('vec512-fp', r"p[sdh]\s+%zmm"))))
+
+def line_atts(text):
+  atts = 0
+  if '%' in text:
+    for a in Attributes:
+      if a[1].search(text): atts |= a[2]
+  return atts
+
+def line_timing(text):
+  x = text[text.index('#'):].split()
+  cycles = int(x[x.index('cycles') - 1]) if 'cycles' in x else None
+  ipc = round(float(x[-2]), 1) if x[-1] == 'IPC' else None
   return cycles, ipc
 
-def tripcount(ip, loop_ipc, state):
-  if state == 'new' and loop_ipc in loops:
-    if not 'tripcount' in loops[loop_ipc]: loops[loop_ipc]['tripcount'] = {}
-    state = 'valid'
-  elif type(state) == int:
-    if ip == loop_ipc: state += 1
-    elif not is_in_loop(ip, loop_ipc):
-      inc(loops[loop_ipc]['tripcount'], str(state))
-      state = 'done'
-  elif state == 'valid':
-    if ip == loop_ipc:
-      state = 1
-  return state
-
-def loop_stats(line, loop_ipc, tc_state):
-  def mark(regex, tag):
-    if re.findall(regex, line):
-      if not loop_stats.atts or not tag in loop_stats.atts:
-        loop_stats.atts = ';'.join((loop_stats.atts, tag)) if loop_stats.atts else tag
+# tokenize - convert a line of text into a Line record
+# instruction lines repeat a lot in LBR streams, hence they are memoized by their text
+# less the timing comment of taken branches
+def tokenize(text):
+  taken = text.find('#')
+  key = text if taken < 0 else text[:taken]
+  inst = tokenize.insts.get(key)
+  if inst:
+    if taken < 0: return inst
+    cycles, ipc = line_timing(text)
+    return Line(INST, inst.ip, True, cycles, ipc, inst.mnem, inst.atts, text.rstrip('\r\n'))
+  if ':' in text:
+    header = is_header(text)
+    if header:
+      x = C.str2list(text)
+      try:
+        ip = int(x[6 if '[' in header.group(1) else 5], 16)
+      except (IndexError, ValueError):
+        ip = None
+      return Line(HEADER, ip, False, None, None, header.group(3)[:-1], 0, text.rstrip('\r\n'))
+  if text == '\n': kind = EMPTY
+  elif 'not reaching sample' in text: kind = UNREACHED
+  elif is_label(text): kind = LABEL
+  elif not text.strip().startswith('0'): kind = OTHER
+  else:
+    x = key.split(None, 2)
+    if len(tokenize.insts) >= tokenize.max_insts: tokenize.insts.clear()
+    tokenize.insts[key] = Line(INST, str2int(x[0], (text, None)), False, None, None,
+      x[1] if len(x) > 1 else '', line_atts(key), key.rstrip('\r\n'))
+    return tokenize(text)
+  return Line(kind, None, False, None, None, None, 0, text.rstrip('\r\n'))
+tokenize.insts = {}
+tokenize.max_insts = 2 ** 18
+
+# next_line - next Line record of the input; None once input ended
+def next_line():
+  if cache['in']: return next(cache['in'], None)
+  text = read_line()
+  if not text:
+    if cache['out']: cache['out'].close()
+    return None
+  line = tokenize(text)
+  if cache['out']: cache['out'].add(line)
+  return line
+
+#
+# LBR cache: tokenized samples of a perf.data file in memory-mappable columnar arrays, one file per column:
+#   flags:  per line; kind in bits 0-2, taken in bit 3, loop-body attributes in bits 4-7
+#   ips:    per line; IP of instructions (from/to of a taken branch are its IP and the next one), sample IP of headers
+#   names:  per line; index into meta['names'] of the mnemonic of instructions, the event name of headers
+#   cycles, ipcs: per taken branch; cycles (0 if none) and IPC*10 (0xffff if none)
+#   samples, events: per sample; offset of the header line and event id
+#   headers: raw text of header lines
+# Enable it with LBR_CACHE=<perf.data>[:tag], where tag should reflect the perf script flags used, e.g. -c <comm>.
+# A valid cache replaces stdin altogether, else one is written as stdin is consumed.
+#
+Cache_version = 1
+Cache_columns = (('flags', 'B'), ('ips', 'Q'), ('names', 'H'), ('cycles', 'I'), ('ipcs', 'H'),
+                 ('samples', 'Q'), ('events', 'H'))
+TAKEN = 0x8
+cache = {'in': None, 'out': None}
+
+def cache_path(spec):
+  data, tag = spec.split(':', 1) if ':' in spec else (spec, None)
+  return data, '%s%s.lbr' % (data, '.' + C.chop(tag, ' /') if tag else '')
+
+def cache_key(data):
+  st = os.stat(data)
+  return [os.path.abspath(data), st.st_size, int(st.st_mtime)]
+
+def cache_valid(spec):
+  if sys.version_info[0] < 3: return False
+  data, path = cache_path(spec)
+  try:
+    with open(os.path.join(path, 'meta.json')) as f: meta = json.load(f)
+    return meta['version'] == Cache_version and meta['data'] == cache_key(data)
+  except (IOError, OSError, ValueError, KeyError):
+    return False
+
+class CacheWriter:
+  def __init__(self, spec):
+    self.data, self.path = cache_path(spec)
+    self.tmp = '%s.tmp%d' % (self.path, os.getpid())
+    os.makedirs(self.tmp)
+    self.files = {c[0]: open(os.path.join(self.tmp, c[0]), 'wb') for c in Cache_columns}
+    self.headers = open(os.path.join(self.tmp, 'headers'), 'w')
+    self.names, self.nlines = {}, 0
+    self.new_cols()
+
+  def new_cols(self): self.cols = {c[0]: array(c[1]) for c in Cache_columns}
+
+  def name(self, n):
+    if not n in self.names: self.names[n] = len(self.names)
+    return self.names[n]
+
+  def add(self, line):
+    cols = self.cols
+    if line.kind == HEADER:
+      cols['samples'].append(self.nlines)
+      cols['events'].append(self.name(line.mnem))
+      self.headers.write(line.text + '\n')
+    cols['flags'].append(line.kind | (TAKEN if line.taken else 0) | (line.atts << 4))
+    cols['ips'].append(line.ip or 0)
+    cols['names'].append(self.name(line.mnem) if line.mnem is not None else 0)
+    if line.taken:
+      cols['cycles'].append(line.cycles or 0)
+      cols['ipcs'].append(0xffff if line.ipc is None else int(round(line.ipc * 10)))
+    self.nlines += 1
+    if len(cols['flags']) >= 2 ** 20: self.flush()
+
+  def flush(self):
+    for c in self.cols: self.cols[c].tofile(self.files[c])
+    self.new_cols()
+
+  def close(self):
+    self.flush()
+    for f in list(self.files.values()) + [self.headers]: f.close()
+    names = sorted(self.names, key=lambda n: self.names[n])
+    with open(os.path.join(self.tmp, 'meta.json'), 'w') as f:
+      json.dump({'version': Cache_version, 'data': cache_key(self.data), 'lines': self.nlines, 'names': names}, f)
+    try:
+      os.rename(self.tmp, self.path)
+    except OSError: # e.g. another writer got there first
+      C.exe_cmd('rm -rf %s' % self.tmp)
+    else: C.printf('wrote: %s\n' % self.path)
+    cache['out'] = None
+
+def cache_load(path):
+  with open(os.path.join(path, 'meta.json')) as f: meta = json.load(f)
+  cols = {}
+  for c, t in Cache_columns:
+    with open(os.path.join(path, c), 'rb') as f:
+      cols[c] = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(t) \
+        if os.fstat(f.fileno()).st_size else array(t)
+  return meta, cols
+
+# cache_lines - replay the Line records of a cache
+def cache_lines(path):
+  meta, cols = cache_load(path)
+  names = meta['names']
+  headers = open(os.path.join(path, 'headers'))
+  cycles, ipcs = iter(cols['cycles']), iter(cols['ipcs'])
+  insts, others = {}, {}
+  for flags, ip, name in zip(cols['flags'], cols['ips'], cols['names']):
+    kind = flags & 0x7
+    if kind == INST:
+      if flags & TAKEN:
+        c, i = next(cycles), next(ipcs)
+        yield Line(INST, ip, True, c or None, None if i == 0xffff else i / 10.0, names[name], flags >> 4,
+                   '\t%016x\t\t%s' % (ip, names[name]))
+        continue
+      key = (ip, name, flags)
+      if not key in insts:
+        if len(insts) >= tokenize.max_insts: insts.clear()
+        insts[key] = Line(INST, ip, False, None, None, names[name], flags >> 4, '\t%016x\t\t%s' % (ip, names[name]))
+      yield insts[key]
+    elif kind == HEADER:
+      yield Line(HEADER, ip or None, False, None, None, names[name], 0, headers.readline().rstrip('\n'))
+    else:
+      if not kind in others: others[kind] = Line(kind, None, False, None, None, None, 0, '')
+      yield others[kind]
+  headers.close()
+
+def cache_init():
+  spec = os.getenv('LBR_CACHE')
+  if not spec or cache['in'] or cache['out'] or shard['on']: return
+  if sys.version_info[0] < 3: return C.warn('LBR cache requires python3')
+  data, path = cache_path(spec)
+  if cache_valid(spec):
+    C.printf('reading: %s\n' % path)
+    cache['in'] = cache_lines(path)
+  elif os.path.isfile(data):
+    cache['out'] = CacheWriter(spec)
+  else: C.warn('LBR cache: no such perf.data %s' % data)
+
+#
+# Decode cache: the perf script text of a perf.data, gzip'ed next to it as <perf.data>.script.gz,
+# so the (slow) decode of its LBRs runs once for all consumers. It is re-decoded once the perf.data changes.
+#
+Script_flags = '-F +brstackinsn --xed'
+
+def script_path(data): return data + '.script.gz'
+
+def script_valid(data):
+  try:
+    with open(script_path(data) + '.json') as f: return json.load(f) == {'data': cache_key(data), 'flags': Script_flags}
+  except (IOError, OSError, ValueError):
+    return False
+
+def script_decode(data, perf='perf'):
+  path = script_path(data)
+  tmp = '%s.tmp%d' % (path, os.getpid())
+  p = subprocess.Popen('%s script -i %s %s' % (perf, data, Script_flags), shell=True, stdout=subprocess.PIPE)
+  with gzip.open(tmp, 'wb', compresslevel=1) as f: shutil.copyfileobj(p.stdout, f, 2 ** 20)
+  if p.wait():
+    os.remove(tmp)
+    C.error('perf script failed decoding %s' % data)
+  os.rename(tmp, path)
+  with open(path + '.json', 'w') as f: json.dump({'data': cache_key(data), 'flags': Script_flags}, f)
+  C.printf('wrote: %s\n' % path)
+
+# script_lines - stream the perf script text of a perf.data off its decode cache, decoding it first if stale
+# @comm:  only samples of this command, as perf script -c
+def script_lines(data, comm=None, perf='perf'):
+  if sys.version_info[0] < 3:
+    lines = subprocess.Popen('%s script -i %s %s' % (perf, data, Script_flags), shell=True,
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout
+  else:
+    if not script_valid(data): script_decode(data, perf)
+    lines = gzip.open(script_path(data), 'rt')
+  return comm_filter(lines, comm) if comm else lines
+
+def header_comm(text):
+  header = is_header(text)
+  if not header: return None
+  x = header.group(1).split()
+  return ' '.join(x[:-3 if len(x) > 3 and x[-2].startswith('[') else -2])
+
+def comm_filter(lines, comm):
+  keep = False
+  for text in lines:
+    if text[:1] not in ('\t', '\n'):
+      c = header_comm(text)
+      if c is not None: keep = c == comm
+    if keep: yield text
+
+def header_ip(line):
+  assert line.kind == HEADER, "Not a head of sample: " + line.text
+  assert line.ip is not None, "expect address in '%s'" % line.text
+  return line.ip
+
+# tripcount - count iterations of tracked loops in current sample
+# @tc:  per-sample state; maps a loop to its iterations so far, None once it was exited
+def tripcount(ip, tc):
+  for l in tc:
+    if tc[l] is None: continue
+    if ip == l: tc[l] += 1
+    elif not is_in_loop(ip, l):
+      loops[l].tripcount.add(tc[l])
+      tc[l] = None
+  # a loop's 1st iteration; but not at the line that detected it
+  if ip in tracked and not ip in tc and ip in loops and loops[ip].hotness > 1:
+    if loops[ip].tripcount is None: loops[ip].tripcount = Hist()
+    tc[ip] = 1
+
+def mark_atts(atts, bits):
+  for a in Attributes:
+    if bits & a[2] and not a[0] in atts: atts = ';'.join((atts, a[0])) if atts else a[0]
+  return atts
+
+def exit_loop(loop, atts):
+  if len(atts) > len(loops[loop].attributes): loops[loop].attributes = atts
+
+def loop_stats(line, tc_state, tc, first):
   # loop-body stats, FIXME: on the 1st encoutered loop in a new sample for now
   if loop_stats_en and tc_state == 'new' and is_loop(line):
-    loop_stats.id = line_ip(line)
+    loop_stats.id = line.ip
     loop_stats.atts = ''
+    loop_stats.prefix = None
+  elif loop_stats.prefix is not None: shard_prefix(line)
   if loop_stats.id:
-    if not is_in_loop(line_ip(line), loop_stats.id): #just exited a loop
-      if len(loop_stats.atts) > len(loops[loop_stats.id]['attributes']):
-        loops[loop_stats.id]['attributes'] = loop_stats.atts
+    if not is_in_loop(line.ip, loop_stats.id): #just exited a loop
+      exit_loop(loop_stats.id, loop_stats.atts)
       loop_stats.atts = ''
       loop_stats.id = None
-    else:
-      mark(r"(jmp|call)\s%", 'indirect')
-      mark(r"p[sdh]\s+%xmm", 'vec128-fp')
-      mark(r"p[sdh]\s+%ymm", 'vec256-fp')
-      mark(r"p[sdh]\s+%zmm", 'vec512-fp')
-  return tripcount(line_ip(line), loop_ipc, tc_state)
+    elif line.atts: loop_stats.atts = mark_atts(loop_stats.atts, line.atts)
+  if tc_state == 'new':
+    if any(l in loops for l in tracked) if first else (line.ip in tracked and line.ip in loops):
+      tc_state = 'valid'
+  elif tracked:
+    tripcount(line.ip, tc)
+  return tc_state
 loop_stats.id = None
 loop_stats.atts = ''
+loop_stats.prefix = None # recorded by shards; see shard_prefix()
 loop_stats_en = False
 
-bwd_br_tgts = [] # better make it local to read_sample..
-def detect_loop(ip, lines, loop_ipc,
+bwd_br_tgts = set() # better make it local to read_sample..
+def detect_loop(ip, lines,
   MOLD=4e4): #Max Outer Loop Distance
-  global loop_cycles, bwd_br_tgts #unlike nonlocal, global works in python2 too!
   def find_block_ip():
     x = len(lines)-2
     while x>=0:
-      if is_taken(lines[x]):
-        return line_ip(lines[x+1])
+      if lines[x].taken:
+        return lines[x+1].ip
       x -= 1
     return 0
-  
+
+  prev = lines[-1]
   if ip in loops:
     loop = loops[ip]
-    loop['hotness'] += 1
-    if ip == loop_ipc and is_taken(lines[-1]):
-      if not 'IPC' in loop: loop['IPC'] = {}
+    loop.hotness += 1
+    if ip in tracked and prev.taken:
+      if loop.ipc is None: loop.ipc = Hist()
       begin = find_block_ip()
-      if begin == ip and 'IPC' in lines[-1]:
-        cycles, ipc = line_timing(lines[-1])
-        inc(loop['IPC'], ipc)
-        loop_cycles += cycles
-    if not loop['size'] and not loop['outer'] and len(lines)>2 and\
-      line_ip(lines[-1]) == loop['back']:
+      if begin == ip and prev.ipc is not None:
+        loop.ipc.add(int(round(prev.ipc * 10)))
+        loop.cycles += prev.cycles
+    if not loop.size and not loop.outer and len(lines)>2 and\
+      prev.ip == loop.back:
       size = 0
       x = len(lines)-1
       while x >= 1:
         size += 1
-        inst_ip = line_ip(lines[x])
+        inst_ip = lines[x].ip
         if inst_ip == ip:
-          loop['size'] = size
+          loop.size = size
           break
-        elif inst_ip < ip or inst_ip > loop['back']:
+        elif inst_ip < ip or inst_ip > loop.back:
           break
         x -= 1
-    if not loop['entry-block'] and not is_taken(lines[-1]):
-      loop['entry-block'] = find_block_ip()
+    if not loop.entry and not prev.taken:
+      loop.entry = find_block_ip()
     return
-  xip = line_ip(lines[-1])
+  xip = prev.ip
   # only simple loops that are entirely observed in a single sample are supported
-  if is_taken(lines[-1]):
+  if prev.taken:
     if ip in bwd_br_tgts and xip > ip:
-      inner, outer = 0, 0
-      ins, outs = set(), set()
-      for l in loops:
-        if ip > l and xip < loops[l]['back']:
-          inner += 1
-          outs.add(hex(l))
-          loops[l]['outer'] = 1
-          loops[l]['inner-loops'].add(hex(ip))
-        if ip < l and xip > loops[l]['back']:
-          outer = 1
-          ins.add(hex(l))
-          loops[l]['inner'] += 1
-          loops[l]['outer-loops'].add(hex(ip))
-      loops[ip] = {'back': xip, 'hotness': 1, 'size': None, 'attributes': '',
-        'entry-block': 0 if xip > ip else find_block_ip(),
-        'inner': inner, 'outer': outer, 'inner-loops': ins, 'outer-loops': outs
-      }
-      bwd_br_tgts.remove(ip)
+      add_loop(ip, xip, 0 if xip > ip else find_block_ip())
+      bwd_br_tgts.discard(ip)
       return
     if ip < xip and\
       ((xip - ip) < MOLD) and\
-      not ('call' in lines[-1] or 'ret' in lines[-1]): #these require --xed with perf script
-      bwd_br_tgts += [ip]
+      not ('call' in prev.mnem or 'ret' in prev.mnem): #these require --xed with perf script
+      bwd_br_tgts.add(ip)
+
+# Hist - a histogram that LBR samples add several entries to, e.g. an IPC per iteration of a loop.
+# As samples rather than entries are what LBR_SAMPLE samples, a sampled histogram also keeps sums over samples of
+# the entries m each added, and the entries y of each bucket, for a cluster-robust variance of a bucket's share p:
+# n/(n-1) * sum((y - p*m)^2) / sum(m)^2 over n samples. Entries of the current sample are held in cur.
+class Hist(dict):
+  def __init__(self):
+    dict.__init__(self)
+    self.cur, self.last = {} if sampling['scale'] != 1 else None, None
+    self.n, self.m1, self.m2, self.y2, self.ym = 0, 0, 0, {}, {}
+
+  def add(self, b):
+    self[b] = self.get(b, 0) + 1
+    if self.cur is None: return
+    if self.last != sampling['seq']:
+      self.flush()
+      self.last = sampling['seq']
+    inc(self.cur, b)
+
+  def flush(self):
+    if not self.cur: return
+    m = sum(self.cur.values())
+    self.n, self.m1, self.m2 = self.n + 1, self.m1 + m, self.m2 + m * m
+    for k, y in self.cur.items():
+      self.y2[k] = self.y2.get(k, 0) + y * y
+      self.ym[k] = self.ym.get(k, 0) + y * m
+    self.cur = {}
+
+  def merge(self, x):
+    for h in (self, x): h.flush()
+    self.n, self.m1, self.m2 = self.n + x.n, self.m1 + x.m1, self.m2 + x.m2
+    merge_hist(self.y2, x.y2)
+    merge_hist(self.ym, x.ym)
+
+  # decay - weigh samples so far by f, as their entries are
+  def decay(self, f):
+    self.flush()
+    self.n, self.m1, self.m2 = self.n * f, self.m1 * f, self.m2 * f
+    for d in (self.y2, self.ym):
+      for k in d: d[k] *= f
+
+  # var - variance of share p of bucket k
+  def var(self, k, p):
+    self.flush()
+    if self.n < 2: return p * (1 - p) / max(self.n, 1)
+    v = self.y2.get(k, 0) - 2 * p * self.ym.get(k, 0) + p * p * self.m2
+    return max(v, 0) * self.n / (self.n - 1) / self.m1 ** 2
+
+# Loop - record of a detected loop
+#   back: IP of its backward branch; entry: IP of the block it was entered from; size: in instructions
+#   inner: number of loops it is nested in, listed in outer_loops; outer: set if others are nested in it, listed in inner_loops
+#   ipc, tripcount: Hists of tracked loops; IPC in tenths, and tripcounts where a negative one is a lower bound
+#   cycles: sum over iterations in the ipc histogram
+#   report: stats derived by print_all()
+class Loop(object):
+  __slots__ = ('back', 'hotness', 'size', 'attributes', 'entry', 'inner', 'outer', 'inner_loops', 'outer_loops',
+               'ipc', 'tripcount', 'cycles', 'report')
+  def __init__(self, back, entry, inner, outer, inner_loops, outer_loops):
+    self.back, self.hotness, self.size, self.attributes, self.entry = back, 1, None, '', entry
+    self.inner, self.outer, self.inner_loops, self.outer_loops = inner, outer, inner_loops, outer_loops
+    self.ipc, self.tripcount, self.cycles, self.report = None, None, 0, None
+
+# add_loop - a new loop at ip whose backward branch is at back; nests it with known loops unless outer is given
+def add_loop(ip, back, entry=0, outer=None):
+  inner, ins, outs = 0, (), ()
+  if outer is None:
+    outer = 0
+    for l in nest_candidates(ip, back):
+      loop = loops[l]
+      if ip > l and back < loop.back:
+        inner += 1
+        outs += (l, )
+        loop.outer = 1
+        loop.inner_loops += (ip, )
+      if ip < l and back > loop.back:
+        outer = 1
+        ins += (l, )
+        loop.inner += 1
+        loop.outer_loops += (ip, )
+  loops[ip] = Loop(back, entry, inner, outer, ins, outs)
+  bisect.insort(loop_index['starts'], ip)
+  loop_index['span'] = max(loop_index['span'], back - ip)
+  loop_index['order'][ip] = next(loop_index['seq'])
+
+# loop_index - start IPs of loops sorted, the longest loop and detection order
+loop_index = {}
+
+def del_loop(ip):
+  loop = loops.pop(ip)
+  starts = loop_index['starts']
+  del starts[bisect.bisect_left(starts, ip)]
+  del loop_index['order'][ip]
+  for l in loop.outer_loops:
+    if l in loops: loops[l].inner_loops = tuple(x for x in loops[l].inner_loops if x != ip)
+  for l in loop.inner_loops:
+    if l in loops:
+      loops[l].outer_loops = tuple(x for x in loops[l].outer_loops if x != ip)
+      loops[l].inner -= 1
+  if loop_stats.id == ip: loop_stats.id, loop_stats.atts = None, ''
+
+# nest_candidates - loops that may enclose [ip, back] or be enclosed by it, in detection order
+# an enclosing loop starts after back-span; an enclosed one starts after ip and before back
+def nest_candidates(ip, back):
+  starts = loop_index['starts']
+  x = starts[bisect.bisect_right(starts, min(ip, back - loop_index['span'])):bisect.bisect_left(starts, back)]
+  return sorted(x, key=loop_index['order'].get) if len(x) > 1 else x
+
+# Sketch - HyperLogLog estimate of the number of distinct integers added, in 2^p bytes
+class Sketch(object):
+  def __init__(self, p=12):
+    self.p, self.regs = p, bytearray(1 << p)
+
+  def add(self, x):
+    M = 0xffffffffffffffff # splitmix64 finalizer
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & M
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & M
+    x ^= x >> 31
+    i, w = x >> (64 - self.p), x & ((1 << (64 - self.p)) - 1)
+    rank = 65 - self.p - w.bit_length()
+    if self.regs[i] < rank: self.regs[i] = rank
+
+  def merge(self, other):
+    self.regs = bytearray(max(a, b) for a, b in zip(self.regs, other.regs))
+
+  def __len__(self):
+    m = float(len(self.regs))
+    e = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.regs)
+    zeros = self.regs.count(0)
+    if e <= 2.5 * m and zeros: e = m * math.log(m / zeros) # linear counting of small sets
+    return int(round(e))
+
+def popcount(b): return bin(int(binascii.hexlify(b), 16)).count('1') if len(b) else 0
+
+#
+# Footprint - 64B code lines, 4K and 2M pages touched, in fixed memory.
+# 2M regions are tracked exactly by bitmaps of their lines and 4K pages, up to max_regions of them;
+# lines of any others are estimated by sketches.
+# IP ranges sampled per DSO attribute the tracked regions to DSOs.
+#
+class Footprint(object):
+  Region = 4096 + 64 # bytes of a 2M region's bitmap: a bit per line, then a bit per 4K page
+
+  def __init__(self, max_regions=2048):
+    self.max_regions = max_regions
+    self.clear()
+
+  def clear(self):
+    self.regions, self.sketches, self.dsos, self.old = {}, None, {}, None
+
+  def touched(self): return bool(self.regions or self.sketches) or self.old is not None
+
+  # age - forget the previous generation of lines, the current one becomes previous
+  def age(self):
+    old = Footprint(self.max_regions)
+    old.regions, old.sketches = self.regions, self.sketches
+    self.old, self.regions, self.sketches = old, {}, None
+
+  # window - the current and previous generations combined
+  def window(self):
+    if self.old is None: return self
+    w = Footprint(2 * self.max_regions)
+    w.merge(self.old)
+    w.merge(self)
+    return w
+
+  def add(self, ip):
+    r = self.regions.get(ip >> 21)
+    if r is None:
+      if len(self.regions) >= self.max_regions: return self.add_sparse(ip)
+      r = self.regions[ip >> 21] = bytearray(Footprint.Region)
+    x = (ip >> 6) & 0x7fff
+    b, m = x >> 3, 1 << (x & 7)
+    if r[b] & m: return
+    r[b] |= m
+    r[4096 + (x >> 9)] |= 1 << ((x >> 6) & 7)
+
+  def add_sparse(self, ip):
+    if not self.sketches: self.sketches = (Sketch(), Sketch(), Sketch())
+    for s, shift in zip(self.sketches, (6, 12, 21)): s.add(ip >> shift)
+
+  # sample_ip - note the IP of a sample and its DSO; @text: header of the sample
+  def sample_ip(self, ip, text):
+    if ip is None or not text.endswith(')'): return
+    dso = text[text.rfind('(') + 1:-1]
+    r = self.dsos.get(dso)
+    if r is None: self.dsos[dso] = [ip, ip]
+    elif ip < r[0]: r[0] = ip
+    elif ip > r[1]: r[1] = ip
+
+  def merge(self, other):
+    for k, r in other.regions.items():
+      if k in self.regions: self.regions[k] = bytearray(a | b for a, b in zip(self.regions[k], r))
+      elif len(self.regions) < self.max_regions: self.regions[k] = r
+      else:
+        for x in range(4096 * 8):
+          if r[x >> 3] & (1 << (x & 7)): self.add_sparse((k << 21) | (x << 6))
+    if other.sketches:
+      if not self.sketches: self.sketches = (Sketch(), Sketch(), Sketch())
+      for s, o in zip(self.sketches, other.sketches): s.merge(o)
+    for dso, r in other.dsos.items():
+      if not dso in self.dsos: self.dsos[dso] = r
+      else: self.dsos[dso] = [min(self.dsos[dso][0], r[0]), max(self.dsos[dso][1], r[1])]
+
+  def __len__(self): return self.counts()[0]
+
+  # counts - number of lines, 4K pages and 2M pages
+  def counts(self):
+    x = [sum(popcount(r[:4096]) for r in self.regions.values()),
+         sum(popcount(r[4096:]) for r in self.regions.values()), len(self.regions)]
+    if self.sketches: x = [a + len(s) for a, s in zip(x, self.sketches)]
+    return x
+
+  # breakdown - counts per DSO, larger first; pages out of sampled ranges are [other], sketched ones are [sparse]
+  def breakdown(self):
+    ranges = sorted((r[0], r[1], dso) for dso, r in self.dsos.items())
+    starts = [r[0] for r in ranges]
+    res = {}
+    for k in sorted(self.regions):
+      r = self.regions[k]
+      for p in range(512):
+        if not r[4096 + (p >> 3)] & (1 << (p & 7)): continue
+        page = (k << 21) | (p << 12)
+        i = bisect.bisect_right(starts, page + 4095) - 1
+        dso = ranges[i][2] if i >= 0 and ranges[i][1] >= page else '[other]'
+        if not dso in res: res[dso] = [0, 0, set()]
+        res[dso][0] += popcount(r[p * 8:p * 8 + 8])
+        res[dso][1] += 1
+        res[dso][2].add(k)
+    res = [(dso, (x[0], x[1], len(x[2]))) for dso, x in res.items()]
+    if self.sketches: res.append(('[sparse]', tuple(len(s) for s in self.sketches)))
+    return sorted(res, key=lambda x: x[1][0], reverse=True)
 
 LBR_Event = pmu.lbr_event()[:-4]
 lbr_events = []
 loops = {}
-stat = {x: 0 for x in ('bad', 'bogus', 'total')}
-stat['IPs'] = {}
-stat['events'] = {}
-stat['size'] = {'min': 0, 'max': 0, 'avg': 0}
+stat = {}
 size_sum=0
-loop_cycles=0
+tracked = set() # loops to collect IPC & tripcount histograms for
 dsb = {}
-footprint = set()
+footprint = Footprint()
+sampling = {}
+
+# reset - forget all samples read so far
+def reset():
+  global size_sum
+  for x in (loops, stat, dsb, footprint): x.clear()
+  loop_index.update(starts=[], span=0, order={}, seq=itertools.count())
+  del lbr_events[:]
+  stat.update({x: 0 for x in ('bad', 'bogus', 'total')})
+  stat.update(IPs={}, events={}, size={'min': 0, 'max': 0, 'avg': 0})
+  size_sum = 0
+  loop_stats.id, loop_stats.atts = None, ''
+  sampling.update(scale=1, rng=random.Random(1), seq=0)
+reset()
+
+def edge_prof(event, ip_filter, loop_ipc, loop_hot): # config good for edge-profile
+  return event.startswith(LBR_Event) and not ip_filter and not loop_ipc and not loop_hot
+def dsb_heat_en(): return pmu.dsb_msb() and not pmu.cpu('smt-on')
 
+def loop_ips(loop_ipc): return loop_ipc if isinstance(loop_ipc, (list, tuple)) else ([loop_ipc] if loop_ipc else [])
+
+# read_sample - read next valid sample off stdin
+# @loop_ipc:  IP of a loop, or a list of such, to collect IPC & tripcount histograms for
+# @loop_hot:  collect those histograms for all loops; ones this hot are reported by print_all()
+# @decimate:  analyze a random 1-in-decimate of samples, skipping others cheaply
+# returns the sample as a list of Line records, header first; None once input ended
 def read_sample(ip_filter=None, skip_bad=True, min_lines=0, labels=False,
-                loop_ipc=0, lp_stats_en=False, event = LBR_Event):
-  global lbr_events, size_sum, bwd_br_tgts, loop_stats_en
-  valid, lines, bwd_br_tgts = 0, [], []
+                loop_ipc=0, lp_stats_en=False, event = LBR_Event, loop_hot=0, decimate=1):
+  global size_sum, bwd_br_tgts, loop_stats_en, tracked
+  valid, lines, bwd_br_tgts = 0, [], set()
   size_stats_en = skip_bad and not labels
   loop_stats_en = lp_stats_en
-  edge_en = event.startswith(LBR_Event) and not ip_filter and not loop_ipc # config good for edge-profile
-  if stat['total']==0 and edge_en and pmu.dsb_msb() and not pmu.cpu('smt-on'):
+  tracked = loops if loop_hot else set(loop_ips(loop_ipc))
+  edge_en = edge_prof(event, ip_filter, loop_ipc, loop_hot)
+  if stat['total']==0: cache_init()
+  if stat['total']==0 and edge_en and (shard['heatmap'] if shard['on'] else dsb_heat_en()):
     #dsb_heat_en = 1; len(dsb) == dsb_heat_en
-    dsb['heatmap'] = {}
+    dsb['heatmap'] = Hist()
     if debug: C.printf('DBG=%s\n' % debug)
-  
+
   while not valid:
-    valid, lines, bwd_br_tgts = 1, [], []
+    if decimate > 1 and sampling['rng'].randrange(decimate) and read_raw(): continue
+    valid, lines, bwd_br_tgts = 1, [], set()
     xip, timestamp = None, None
-    tc_state = 'new'
+    tc_state, tc = 'new', {}
     stat['total'] += 1
-    if stat['total'] % 1000 == 0: C.printf('.')
+    sampling['seq'] += 1
+    if stat['total'] % 1000 == 0 and not shard['on']: C.printf('.')
     while True:
-      line = read_line()
+      line = next_line()
       # input ended
       if not line:
-        if size_stats_en:
-          total = stat['IPs'][ip_filter] if ip_filter else stat['total']
-          stat['size']['avg'] = round(size_sum / (total - stat['bad'] - stat['bogus']), 1)
         if len(lines): stat['bogus'] += 1
-        if stat['total'] == stat['bogus']:
-          print_all()
-          C.error('No LBR data in profile')
-        C.printf(' .\n')
+        if not shard['on']: end_stats(ip_filter, size_stats_en)
         return lines if len(lines) and not skip_bad else None
-      header = is_header(line)
+      text, kind = line.text, line.kind
+      header = kind == HEADER
       if header:
         # first sample here (of a given event)
-        ev = header.group(3)[:-1]
-        if not ev in lbr_events:
-          lbr_events += [ev]
-          x = 'events= %s @ %s' % (str(lbr_events), header.group(1).split(' ')[-1])
-          if len(lbr_events) == 1: x += ' primary= %s' % event
-          if ip_filter: x += ' ip_filter= %s' % ip_filter
-          if loop_ipc: x += ' loop= %s' % hex(loop_ipc)
-          C.printf(x+'\n')
+        ev = line.mnem
+        if not ev in lbr_events: new_event(ev, text, event, ip_filter, loop_ipc, loop_hot)
         inc(stat['events'], ev)
-        if debug: timestamp = header.group(1).split()[-1]
+        if edge_en: footprint.sample_ip(line.ip, text)
+        if debug: timestamp = is_header(text).group(1).split()[-1]
       # a new sample started
       # perf  3433 1515065.348598:    1000003 EVENT.NAME:      7fd272e3b217 __regcomp+0x57 (/lib/x86_64-linux-gnu/libc-2.23.so)
         if ip_filter:
-          if not ip_filter in line:
-            valid = skip_sample(line)
+          if not ip_filter in text:
+            valid = skip_sample(text)
             break
           inc(stat['IPs'], ip_filter)
       # a sample ended
-      if re.match(r"^$", line):
+      if kind == EMPTY:
         len_m1 = 0
         if len(lines): len_m1 = len(lines)-1
         if len_m1 == 0 or\
            min_lines and (len_m1 < min_lines) or\
-           header_ip(lines[0]) != line_ip(lines[len_m1]):
+           header_ip(lines[0]) != lines[len_m1].ip:
           valid = 0
           stat['bogus'] += 1
           if debug and debug == timestamp:
-            exit((line.strip(), len(lines)), lines, 'a bogus sample ended')
-        elif len_m1 and type(tc_state) == int and is_in_loop(line_ip(lines[-1]), loop_ipc):
-          if tc_state == 31 or verbose:
-            inc(loops[loop_ipc]['tripcount'], '%d+' % (tc_state + 1))
-          # else: note a truncated tripcount, i.e. unknown in 1..31, is not accounted for by default.
+            exit((text.strip(), len(lines)), lines, 'a bogus sample ended')
+        elif len_m1:
+          for l in tc:
+            if tc[l] is not None and is_in_loop(lines[-1].ip, l) and (tc[l] == 31 or verbose):
+              loops[l].tripcount.add(-(tc[l] + 1))
+            # else: note a truncated tripcount, i.e. unknown in 1..31, is not accounted for by default.
         if debug and debug == timestamp:
-          exit((line.strip(), len(lines)), lines, 'sample-of-interest ended')
+          exit((text.strip(), len(lines)), lines, 'sample-of-interest ended')
         break
       elif header and len(lines): # sample had no LBR data; new one started
         # exchange2_r_0.j 57729 3736595.069891:    1000003 r20c4:pp:            41f47a brute_force_mp_brute_+0x43aa (/home/admin1/ayasin/perf-tools/exchange2_r_0.jmpi4)
@@ -248,34 +738,36 @@ def read_sample(ip_filter=None, skip_bad=True, min_lines=0, labels=False,
         lines = []
         stat['bogus'] += 1 # for this one
         stat['total'] += 1 # for new one
+        sampling['seq'] += 1
       # invalid sample is about to end
-      if skip_bad and 'not reaching sample' in line:
+      if skip_bad and kind == UNREACHED:
         valid = 0
         stat['bad'] += 1
-        assert re.match(r"^$", read_line())
+        x = next_line()
+        assert not x or x.kind == EMPTY
         break
       # a line with a label
-      if not labels and is_label(line):
+      if not labels and kind == LABEL:
         continue
       # e.g. "        prev_nonnote_           addb  %al, (%rax)"
-      if skip_bad and len(lines) and not line.strip().startswith('0'):
+      if skip_bad and len(lines) and kind != INST:
         if debug and debug == timestamp:
-          exit(line, lines, "bad line")
-        valid = skip_sample(lines[0])
+          exit(text, lines, "bad line")
+        valid = skip_sample(lines[0].text)
         stat['bogus'] += 1
         break
-      ip = None if header or is_label(line) else line_ip(line, lines)
+      ip = line.ip if kind == INST else None
       new_line = is_line_start(ip, xip)
-      if edge_en and new_line: footprint.add(ip >> 6)
-      if len(lines) and not is_label(line):
+      if edge_en and new_line: footprint.add(ip)
+      if len(lines) and kind != LABEL:
         # a 2nd instruction
         if len(lines) > 1:
-          detect_loop(ip, lines, loop_ipc)
-          if len(dsb) and (is_taken(lines[-1]) or new_line):
-            inc(dsb['heatmap'], pmu.dsb_set_index(ip))
-        tc_state = loop_stats(line, loop_ipc, tc_state)
-      if len(lines) or event in line:
-        lines += [ line.rstrip('\r\n') ]
+          detect_loop(ip, lines)
+          if len(dsb) and (lines[-1].taken or new_line): dsb_heat(ip)
+        if loop_stats_en or tracked or loop_stats.id:
+          tc_state = loop_stats(line, tc_state, tc, len(lines) == 1)
+      if len(lines) or event in line.text:
+        lines += [line]
       xip = ip
   if size_stats_en:
     size = len(lines) - 1
@@ -286,6 +778,396 @@ def read_sample(ip_filter=None, skip_bad=True, min_lines=0, labels=False,
     size_sum += size
   return lines
 
+def dsb_heat(ip): dsb['heatmap'].add(pmu.dsb_set_index(ip))
+
+def new_event(ev, text, event, ip_filter, loop_ipc, loop_hot):
+  lbr_events.append(ev)
+  if shard['on']: return shard['events'].append((ev, text))
+  x = 'events= %s @ %s' % (str(lbr_events), is_header(text).group(1).split(' ')[-1])
+  if len(lbr_events) == 1: x += ' primary= %s' % event
+  if ip_filter: x += ' ip_filter= %s' % ip_filter
+  if loop_ipc: x += ' loop= %s' % ','.join(hex(l) for l in loop_ips(loop_ipc))
+  if loop_hot: x += ' loop_hot= %d' % loop_hot
+  C.printf(x+'\n')
+
+def size_avg(ip_filter):
+  total = stat['IPs'].get(ip_filter, 0) if ip_filter else stat['total']
+  if total > stat['bad'] + stat['bogus']: stat['size']['avg'] = round(size_sum / (total - stat['bad'] - stat['bogus']), 1)
+
+def end_stats(ip_filter, size_stats_en):
+  if size_stats_en: size_avg(ip_filter)
+  if stat['total'] == stat['bogus']:
+    print_all()
+    C.error('No LBR data in profile')
+  C.printf(' .\n')
+
+#
+# Parallel mode: LBR_JOBS=<jobs>[:<chunk-MB>] splits stdin at sample boundaries into chunks analyzed by a pool of
+# processes. Their states are merged in input order into the one of a serial run:
+#   phase 1 analyzes each chunk on its own. This finds the chunk where each loop is detected first, as that depends
+#           on the loop's own branches only.
+#   phase 2 re-analyzes each chunk seeded with loops detected by earlier chunks, as presence of a loop affects its
+#           hotness, size and histograms. Nesting of loops is replayed by the parent in detection order.
+# Body attributes of a loop that a chunk ends in are completed by the next chunk; see shard_prefix().
+#
+shard = {'on': False}
+
+def read_samples(on_sample, counters={}, report=None, **kwargs):
+  jobs, live, spec = os.getenv('LBR_JOBS'), os.getenv('LBR_LIVE'), os.getenv('LBR_SAMPLE')
+  if spec:
+    if spec.startswith('r'):
+      reservoir(int(spec[1:]))
+      if jobs: C.warn('LBR_JOBS is ignored with LBR_SAMPLE=%s, as its reservoir is held by a single process' % spec)
+      jobs = None
+    else:
+      kwargs['decimate'] = sampling['scale'] = int(spec)
+      stat['sampling'] = '1:%d' % sampling['scale']
+  if os.getenv('LBR_PROFILE'):
+    prof_start(os.getenv('LBR_PROFILE'))
+    if jobs: C.warn('LBR_JOBS is ignored with LBR_PROFILE, as it profiles a single process')
+    jobs = None
+  read_all(on_sample, counters, report, jobs, live, kwargs)
+  if sampling['scale'] != 1: scale(sampling['scale'], counters)
+  if prof: prof_end()
+
+def read_all(on_sample, counters, report, jobs, live, kwargs):
+  if not jobs or os.getenv('LBR_CACHE') or live or cache['in']:
+    n = 0
+    if live:
+      live = live.split(':')
+      clock = time.time if live[0].endswith('s') else lambda: n
+      period, f = float(live[0].rstrip('s')), float(live[1]) if len(live) > 1 else 0.5
+      if not 0 < f < 1: C.error('LBR_LIVE: decay must be in (0, 1) for memory to stay bounded, got %s' % live[1])
+      due = clock() + period
+    while True:
+      sample = read_sample(**kwargs)
+      if not sample: break
+      on_sample(sample)
+      n += 1
+      if live and clock() >= due:
+        live_report(report, counters, f, kwargs.get('ip_filter'))
+        due = clock() + period
+    return
+  import multiprocessing, shutil, tempfile
+  global loop_stats_en
+  jobs = jobs.split(':')
+  shard['args'] = (on_sample, counters, kwargs) # inherited by the forked workers
+  shard['heatmap'] = edge_prof(*(kwargs.get(x, d) for x, d in (('event', LBR_Event), ('ip_filter', None),
+    ('loop_ipc', 0), ('loop_hot', 0)))) and dsb_heat_en()
+  pool = multiprocessing.Pool(int(jobs[0]))
+  tmp = tempfile.mkdtemp(prefix='lbr')
+  try:
+    size = int(float(jobs[1] if len(jobs) > 1 else 32) * 2 ** 20)
+    chunks = [(path, pool.apply_async(shard_run, (path, None))) for path in shard_chunks(tmp, size)]
+    results = []
+    for path, r in chunks:
+      r = r.get()
+      seeds = [(l, loops[l].back, loops[l].outer) for l in loops]
+      results.append(pool.apply_async(shard_run, (path, seeds)) if len(seeds) else r)
+      for l, back in r['created']:
+        if not l in loops: add_loop(l, back)
+    carry = (None, '')
+    for r in results:
+      r = r if isinstance(r, dict) else r.get()
+      carry = shard_carry(carry, r)
+      shard_merge(r, counters, kwargs)
+  finally:
+    pool.terminate()
+    shutil.rmtree(tmp)
+  stat['total'] -= len(results) - 1 # each chunk counted an extra sample at its end
+  loop_stats_en = kwargs.get('lp_stats_en', False)
+  end_stats(kwargs.get('ip_filter'), kwargs.get('skip_bad', True) and not kwargs.get('labels'))
+
+#
+# Live mode: LBR_LIVE=<period>[:<decay>] reports every period samples, or seconds if suffixed by 's', e.g.
+# LBR_LIVE=10s:0.5 on an endless 'perf record -o - | perf script -i -' pipe. Counts are scaled by decay (0.5 by
+# default) after each report so old samples age out, and loops that turn cold are forgotten, keeping memory bounded.
+# The code footprint covers the last two periods.
+#
+def live_report(report, counters, f, ip_filter):
+  if sys.stdout.isatty(): sys.stdout.write('\033[H\033[J') # rewrite the screen
+  size_avg(ip_filter)
+  if report: report()
+  sys.stdout.flush()
+  decay(f, counters)
+
+def decay(f, counters={}):
+  for h in [h for l in loops.values() for h in (l.ipc, l.tripcount)] + [dsb.get('heatmap')]:
+    if h: h.decay(f)
+  scale(f, counters)
+  footprint.age()
+
+# scale - multiply counts of samples read so far by f
+def scale(f, counters={}):
+  global size_sum
+  def scale(d, drop=True):
+    for k in list(d):
+      if not isinstance(d[k], int): continue
+      d[k] = int(d[k] * f)
+      if drop and not d[k]: del d[k]
+  for ip in list(loops):
+    loop = loops[ip]
+    loop.hotness = int(loop.hotness * f)
+    if not loop.hotness:
+      del_loop(ip)
+      continue
+    loop.cycles = int(loop.cycles * f)
+    for h in (loop.ipc, loop.tripcount):
+      if h: scale(h)
+  if 'heatmap' in dsb: scale(dsb['heatmap'])
+  for d in (stat, stat['IPs'], stat['events'], counters): scale(d, False)
+  size_sum = int(size_sum * f)
+
+#
+# Self-profile: LBR_PROFILE=<file.json>[:cprofile] times the phases of read_samples(), i.e. parsing (incl. reading
+# input), loop detection and the DSB heatmap, writing a JSON summary with rates, and optionally a cProfile dump
+# to <file.json>.prof. The phases are timed by wrapping their functions, so nothing is added when it is off.
+# It analyzes serially.
+#
+prof = {}
+
+def prof_timed(name, f):
+  def timed(*args):
+    t = time.time()
+    x = f(*args)
+    prof[name] += time.time() - t
+    return x
+  return timed
+
+def prof_next_line(f):
+  def next_line_timed():
+    t = time.time()
+    line = f()
+    prof['parse'] += time.time() - t
+    if line: prof['lines'] += 1
+    return line
+  return next_line_timed
+
+def prof_start(spec):
+  g = globals()
+  spec = spec.split(':')
+  prof.update(path=spec[0], saved={f: g[f] for f in ('next_line', 'detect_loop', 'dsb_heat')},
+    parse=0.0, loops=0.0, heatmap=0.0, lines=0, wall=time.time(), cpu=sum(os.times()[:2]), cprofile=None)
+  g['next_line'] = prof_next_line(next_line)
+  g['detect_loop'] = prof_timed('loops', detect_loop)
+  g['dsb_heat'] = prof_timed('heatmap', dsb_heat)
+  if 'cprofile' in spec[1:]:
+    import cProfile
+    prof['cprofile'] = cProfile.Profile()
+    prof['cprofile'].enable()
+
+def prof_end():
+  import resource
+  wall, cpu = time.time() - prof['wall'], sum(os.times()[:2]) - prof['cpu']
+  if prof['cprofile']:
+    prof['cprofile'].disable()
+    prof['cprofile'].dump_stats(prof['path'] + '.prof')
+  globals().update(prof['saved'])
+  total = stat['total'] or 1
+  summary = {'lines': prof['lines'], 'samples': stat['total'], 'wall': round(wall, 3), 'cpu': round(cpu, 3),
+    'samples/s': round(stat['total'] / wall, 1), 'lines/s': round(prof['lines'] / wall, 1),
+    'parse': round(prof['parse'], 3), 'loop-detection': round(prof['loops'], 3), 'dsb-heatmap': round(prof['heatmap'], 3),
+    'bad-rate': round(float(stat['bad']) / total, 4), 'bogus-rate': round(float(stat['bogus']) / total, 4),
+    'max-rss-kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+  with open(prof['path'], 'w') as f: json.dump(summary, f, indent=1, sort_keys=True)
+  C.printf('wrote: %s\n' % prof['path'])
+  prof.clear()
+
+#
+# Sampling: LBR_SAMPLE=<K> analyzes a random 1-in-K of samples, LBR_SAMPLE=r<size> a uniformly random reservoir of size samples
+# taken off the whole input. Counts are scaled back up by the sampling ratio, reported ratios get a 95% confidence
+# interval and the code footprint covers analyzed samples only.
+#
+def reservoir(size):
+  cache_init()
+  kept, n = [], 0
+  while True:
+    lines = read_raw()
+    if not lines: break
+    if n < size: kept.append((n, lines))
+    else:
+      i = sampling['rng'].randint(0, n)
+      if i < size: kept[i] = (n, lines)
+    n += 1
+  kept.sort(key=lambda x: x[0])
+  cache['in'] = (x if isinstance(x, Line) else tokenize(x) for s in kept for x in s[1])
+  sampling['scale'] = float(n) / max(len(kept), 1)
+  stat['sampling'] = '%d:%d' % (len(kept), n)
+
+# ci - half width of the 95% confidence interval of ratio x/n where counts were scaled up from sampled ones;
+# binomial for a ratio of samples, else that of bucket key of Hist hist, whose entries come several per sample
+def ci(x, n, hist=None, key=None):
+  if sampling['scale'] == 1 or not n: return ''
+  p = float(x) / n
+  v = p * (1 - p) / max(n / sampling['scale'], 1) if hist is None else hist.var(key, p)
+  return ' +-%.1f%%' % (196.0 * math.sqrt(v))
+
+def ratio(x, histo, denom='total'): return C.ratio(x, histo, denom) + ci(histo[x], histo[denom])
+
+def shard_chunks(tmp, size):
+  buf, n = '', 0
+  while True:
+    x = sys.stdin.read(size)
+    buf += x
+    cut = buf.rfind('\n\n') + 2 if x else len(buf)
+    if cut > 1:
+      path = os.path.join(tmp, '%d' % n)
+      with open(path, 'w') as f: f.write(buf[:cut])
+      buf, n = buf[cut:], n + 1
+      yield path
+    if not x: return
+
+def shard_run(path, seeds):
+  on_sample, counters, kwargs = shard['args']
+  scale = sampling['scale']
+  reset()
+  sampling['scale'] = scale # for Hists to keep the sums of sampled ones
+  shard.update(on=True, events=[], prefix=[], lo=2 ** 64, hi=-1, bits=0)
+  loop_stats.prefix = shard['prefix'] if kwargs.get('lp_stats_en') else None
+  for l, back, outer in seeds or (): add_loop(l, back, 0, outer)
+  for x in counters:
+    if isinstance(counters[x], int): counters[x] = 0
+  sys.stdin = open(path)
+  while True:
+    sample = read_sample(**kwargs)
+    if not sample: break
+    on_sample(sample)
+  sys.stdin.close()
+  return {'created': [(l, loops[l].back) for l in list(loops)[len(seeds or ()):]], 'loops': loops,
+    'footprint': footprint, 'dsb': dsb, 'stat': stat, 'size_sum': size_sum,
+    'events': shard['events'], 'counters': counters, 'prefix': shard['prefix'],
+    'end': None if loop_stats.prefix is not None else (loop_stats.id, loop_stats.atts)}
+
+# shard_prefix - record lines of a chunk up to its first loop_stats.id. Only ones that extend the range of IPs
+# or bring new attributes matter to the loop the previous chunk ended in, if any.
+def shard_prefix(line):
+  s = shard
+  if line.ip < s['lo'] or line.ip > s['hi'] or line.atts & ~s['bits']:
+    s['prefix'].append((line.ip, line.atts))
+    s['lo'], s['hi'], s['bits'] = min(s['lo'], line.ip), max(s['hi'], line.ip), s['bits'] | line.atts
+
+# shard_carry - continue the loop a chunk ended in over the next chunk's prefix
+# @carry: the loop and its attributes so far
+def shard_carry(carry, r):
+  loop, atts = carry
+  if loop:
+    for ip, bits in r['prefix']:
+      if not is_in_loop(ip, loop):
+        exit_loop(loop, atts)
+        loop = None
+        break
+      atts = mark_atts(atts, bits)
+  return r['end'] or (loop, atts)
+
+def merge_hist(hist, x):
+  for k in x: hist[k] = hist.get(k, 0) + x[k]
+  if isinstance(x, Hist): hist.merge(x)
+
+def shard_merge(r, counters, kwargs):
+  global size_sum
+  for ip, l in r['loops'].items():
+    loop = loops[ip]
+    loop.hotness += l.hotness - 1 # seeded or added by parent at 1
+    if not loop.size: loop.size = l.size
+    if not loop.entry: loop.entry = l.entry
+    exit_loop(ip, l.attributes)
+    loop.cycles += l.cycles
+    for x in ('ipc', 'tripcount'):
+      if getattr(l, x) is None: continue
+      if getattr(loop, x) is None: setattr(loop, x, Hist())
+      merge_hist(getattr(loop, x), getattr(l, x))
+  footprint.merge(r['footprint'])
+  if 'heatmap' in r['dsb']: merge_hist(dsb.setdefault('heatmap', Hist()), r['dsb']['heatmap'])
+  for x in ('bad', 'bogus', 'total'): stat[x] += r['stat'][x]
+  for x in ('IPs', 'events'): merge_hist(stat[x], r['stat'][x])
+  if r['size_sum']:
+    size = r['stat']['size']
+    if size_sum == 0: stat['size']['min'], stat['size']['max'] = size['min'], size['max']
+    else:
+      stat['size']['min'] = min(stat['size']['min'], size['min'])
+      stat['size']['max'] = max(stat['size']['max'], size['max'])
+    size_sum += r['size_sum']
+  for ev, text in r['events']:
+    if not ev in lbr_events: new_event(ev, text, kwargs.get('event', LBR_Event), kwargs.get('ip_filter'),
+                                       kwargs.get('loop_ipc', 0), kwargs.get('loop_hot', 0))
+  for x in counters:
+    if isinstance(counters[x], int): counters[x] += r['counters'][x]
+
+#
+# Analyzer: an LBR analysis that keeps its own state, so several can run in one process, e.g. over one pass of the input.
+# Module-level functions work on the active analyzer, made so by a with-statement that swaps its state into the module;
+# the module itself is the default analyzer of stdin. Hence a single analyzer is active per process at a time:
+# analyzers of several threads hold Active for each step, so they run interleaved rather than in parallel.
+# Parallelism is by processes, see LBR_JOBS. LBR_SAMPLE, LBR_LIVE and LBR_PROFILE apply to run() only, not to analyze().
+#
+Active = threading.RLock()
+
+class Analyzer(object):
+  State = ('loops', 'stat', 'dsb', 'footprint', 'lbr_events', 'loop_index', 'cache', 'sampling', 'size_sum',
+           'tracked', 'bwd_br_tgts', 'loop_stats_en')
+
+  # @lines:  text lines of perf script or Line records to read instead of stdin, e.g. an open file
+  # @kwargs: of read_sample()
+  def __init__(self, lines=None, **kwargs):
+    self.kwargs, self.depth = kwargs, 0
+    self.state = {'loops': {}, 'stat': {}, 'dsb': {}, 'footprint': Footprint(), 'lbr_events': [], 'loop_index': {},
+      'cache': {'in': None, 'out': None}, 'sampling': {}, 'size_sum': 0, 'tracked': set(), 'bwd_br_tgts': set(),
+      'loop_stats_en': False}
+    self.loop_stats = (None, '', None)
+    with self: reset()
+    if lines is not None: self.state['cache']['in'] = tokens(lines)
+
+  def __enter__(self):
+    if not self.depth:
+      Active.acquire()
+      g = globals()
+      self.saved = {x: g[x] for x in Analyzer.State}, (loop_stats.id, loop_stats.atts, loop_stats.prefix)
+      g.update(self.state)
+      loop_stats.id, loop_stats.atts, loop_stats.prefix = self.loop_stats
+    self.depth += 1
+    return self
+
+  def __exit__(self, *exc):
+    self.depth -= 1
+    if self.depth: return
+    g = globals()
+    self.state = {x: g[x] for x in Analyzer.State}
+    self.loop_stats = loop_stats.id, loop_stats.atts, loop_stats.prefix
+    g.update(self.saved[0])
+    loop_stats.id, loop_stats.atts, loop_stats.prefix = self.saved[1]
+    Active.release()
+
+  def on_sample(self, sample): pass
+  def report(self): pass
+
+  # step - read and handle the next valid sample; None once input ended
+  def step(self):
+    with self:
+      sample = read_sample(**self.kwargs)
+      if sample: self.on_sample(sample)
+      return sample
+
+  def run(self, counters={}):
+    with self:
+      read_samples(self.on_sample, counters, self.report, **self.kwargs)
+      self.report()
+
+# tokens - Line records of text lines, optionally written to a cache
+def tokens(lines, writer=None):
+  for x in lines:
+    line = x if isinstance(x, Line) else tokenize(x)
+    if writer: writer.add(line)
+    yield line
+  if writer: writer.close()
+
+# analyze - run analyzers over a single pass of lines, tokenized once. Samples are read round-robin, so lines are
+# buffered only as far as analyzers drift apart, e.g. by samples that an ip_filter skips.
+def analyze(analyzers, lines, writer=None):
+  for a, x in zip(analyzers, itertools.tee(tokens(lines, writer), len(analyzers))): a.state['cache']['in'] = x
+  active = list(analyzers)
+  while len(active):
+    active = [a for a in active if a.step()]
+
 def is_header(line): return re.match(r"([^:]*):\s+(\d+)\s+(\S*)\s+(\S*)", line)
 
 def is_jmp_next(br, # a hacky implementation for now
@@ -297,9 +1179,9 @@ def is_jmp_next(br, # a hacky implementation for now
 
 def is_line_start(ip, xip): return (ip >> 6) ^ (xip >> 6) if ip and xip else False
 def is_label(line):   return line.strip().endswith(':')
-def is_loop(line):    return line_ip(line) in loops
-def is_taken(line):   return '#' in line
-def is_in_loop(ip, loop): return ip >= loop and ip <= loops[loop]['back']
+def is_loop(line):    return line.ip in loops
+def is_taken(line):   return line.taken
+def is_in_loop(ip, loop): return ip >= loop and ip <= loops[loop].back
 def get_loop(ip):     return loops[ip] if ip in loops else None
 
 def get_taken(sample, n):
@@ -307,19 +1189,23 @@ def get_taken(sample, n):
   i = len(sample)-1
   frm, to = -1, -1
   while i >= 0:
-    if is_taken(sample[i]):
+    if sample[i].taken:
       n += 1
       if n==0:
-        frm = line_ip(sample[i])
-        if i < (len(sample)-1): to = line_ip(sample[i+1])
+        frm = sample[i].ip
+        if i < (len(sample)-1): to = sample[i+1].ip
         break
     i -= 1
   return {'from': frm, 'to': to, 'taken': 1}
 
 def get_loop_hist(loop_ipc, name, weighted=False, sortfunc=None):
   loop = loops[loop_ipc]
-  assert name in loop
-  return (loop[name], name, loop, loop_ipc, sortfunc, weighted)
+  return (getattr(loop, name.lower()), name, loop, loop_ipc, sortfunc, weighted)
+
+# hist_key - the reported key of a loop histogram
+def hist_key(name, k):
+  if name == 'IPC': return k / 10.0
+  return '%d+' % -k if name == 'tripcount' and k < 0 else k
 
 def print_hist(hist_t):
   if not hist_t[0]: return -1
@@ -330,29 +1216,31 @@ def print_hist(hist_t):
   if not tot: return 0
   if loop:
     shist = sorted(hist.items(), key=lambda x: x[1])
-    loop['%s-most' % name] = str(shist[-1][0])
+    loop.report['%s-most' % name] = str(hist_key(name, shist[-1][0]))
   C.printc('%s histogram%s:' % (name, ' of loop %s' % hex(loop_ipc) if loop_ipc else ''))
-  for k in sorted(hist.keys(), key=sorter): print('%4s: %6d%6.1f%%' % (k, hist[k], 100.0 * hist[k] / tot))
+  for k in sorted(hist.keys(), key=sorter):
+    print('%4s: %6d%6.1f%%%s' % (hist_key(name, k), hist[k], 100.0 * hist[k] / tot, ci(hist[k], tot, hist, k)))
   print('')
-  return sum(hist[k] * int(k.split('+')[0]) for k in hist.keys()) if weighted else tot
+  return sum(hist[k] * abs(k) for k in hist.keys()) if weighted else tot
 
-def print_all(nloops=10, loop_ipc=0):
+def print_all(nloops=10, loop_ipc=0, loop_hot=0):
   stat['detected-loops'] = len(loops)
-  if not loop_ipc: print('LBR samples:', stat)
-  if len(footprint): print('code footprint estimate: %.2f KB\n' % (len(footprint) / 16.0))
+  if not loop_ipc and not loop_hot: print('LBR samples:', stat)
+  if footprint.touched(): print_footprint()
   if len(dsb): print_hist((dsb['heatmap'], 'DSB-Heatmap'))
-  if loop_ipc:
+  for loop_ipc in hot_loops(loop_hot) if loop_hot else loop_ips(loop_ipc):
     if loop_ipc in loops:
       lp = loops[loop_ipc]
+      if lp.report is None: lp.report = {}
       tot = print_hist(get_loop_hist(loop_ipc, 'IPC'))
-      if tot: lp['cyc/iter'] = '%.2f'%(loop_cycles/float(tot))
-      tot = print_hist(get_loop_hist(loop_ipc, 'tripcount', True, lambda x: int(x.split('+')[0])))
-      if tot: lp['tripcount-coverage'] = '%.1f%%' % (100.0 * tot/lp['hotness'])
+      if tot > 0: lp.report['cyc/iter'] = '%.2f'%(lp.cycles/float(tot))
+      tot = print_hist(get_loop_hist(loop_ipc, 'tripcount', True, abs))
+      if tot > 0: lp.report['tripcount-coverage'] = '%.1f%%' % (100.0 * tot/lp.hotness)
     else:
       C.warn('Loop %s was not observed'%hex(loop_ipc))
   if nloops and len(loops):
     C.printc('top %d loops:'%nloops)
-    sloops = sorted(loops.items(), key=lambda x: loops[x[0]]['hotness'])#, reverse=True)
+    sloops = sorted(loops.items(), key=lambda x: x[1].hotness)#, reverse=True)
     if os.getenv("LBR_LOOPS_LOG"):
       log = open(os.getenv("LBR_LOOPS_LOG"), 'w')
       num = len(loops)
@@ -368,46 +1256,107 @@ def print_all(nloops=10, loop_ipc=0):
       print_loop(l[0], nloops)
       nloops -=  1
 
+def print_footprint():
+  w = footprint.window()
+  lines, pages, huge = w.counts()
+  print('code footprint estimate: %.2f KB' % (lines / 16.0))
+  print('code working-set estimate: %d 4K-pages, %d 2M-pages' % (pages, huge))
+  for dso, x in w.breakdown(): print('%10.2f KB %6d 4K-pages %4d 2M-pages  %s' % (x[0] / 16.0, x[1], x[2], dso))
+  print('')
+
+def hot_loops(hotness): # hottest first
+  return sorted((l for l in loops if loops[l].hotness >= hotness), key=lambda l: loops[l].hotness, reverse=True)
+
 def print_br(br):
   print('[from: 0x%x, to: 0x%x, taken: %d]'%(br['from'], br['to'], br['taken']))
 
-def print_loop(ip, num=0, print_to=sys.stdout):
+def print_loop(ip, num=0, print_to=None):
   if not isinstance(ip, int): ip = int(ip, 16) #should use (int, long) but fails on python3
-  def printl(s, end='\n'): return print(s, file=print_to, end=end)
+  def printl(s, end='\n'): return print(s, file=print_to or sys.stdout, end=end)
   if not ip in loops:
     printl('No loop was detected at %s!'%hex(ip))
     return
-  loop = loops[ip].copy()
-  def set2str(s, top=3):
-    new = loop[s]
+  loop = loops[ip]
+  def set2str(ips, top=3):
+    new = set(hex(l) for l in ips)
     if len(new) > top:
       n = len(new) - top
-      new = set()
+      ips, new = new, set()
       while top > 0:
-        new.add(loop[s].pop())
+        new.add(ips.pop())
         top -= 1
       new.add('.. %d more'%n)
-    loop[s] = C.chop(str(sorted(new, reverse=True)), (")", 'set('))
+    return C.chop(str(sorted(new, reverse=True)), (")", 'set('))
   printl('Loop#%d: [ip: %s, hotness: %6d, size: %s, ' %
-    (num, hex(ip), loop['hotness'], '%d'%loop['size'] if loop['size'] else '-'), '')
-  if not loop_stats_en: del loop['attributes']
-  elif not len(loop['attributes']): loop['attributes'] = '-'
-  elif ';' in loop['attributes']: loop['attributes'] = ';'.join(sorted(loop['attributes'].split(';')))
-  for x in ('hotness', 'size'): del loop[x]
-  for x in ('back', 'entry-block'):
-    printl('%s: %s, '%(x, hex(loop[x])), '')
-    del loop[x]
-  for x in ('inn', 'out'): set2str(x + 'er-loops')
-  for x in ('IPC', 'tripcount'):
-    if x in loop: del loop[x]
-  printl(C.chop(str(loop), "'{}\"") + ']')
+    (num, hex(ip), loop.hotness, '%d'%loop.size if loop.size else '-'), '')
+  printl('back: %s, entry-block: %s, ' % (hex(loop.back), hex(loop.entry)), '')
+  x = {}
+  if loop_stats_en: x['attributes'] = ';'.join(sorted(loop.attributes.split(';'))) if loop.attributes else '-'
+  x['inner'], x['outer'] = loop.inner, loop.outer
+  x['inner-loops'], x['outer-loops'] = set2str(loop.inner_loops), set2str(loop.outer_loops)
+  x.update(loop.report or {})
+  printl(C.chop(str(x), "'{}\"") + ']')
 
 def print_sample(sample, n=10):
   if not len(sample): return
-  C.printf('\n'.join(('sample#%d'%stat['total'], sample[0], '\n')))
-  print('\n'.join(sample[-n:] if n else sample) + '\n')
+  C.printf('\n'.join(('sample#%d'%stat['total'], sample[0].text, '\n')))
+  print('\n'.join(l.text for l in (sample[-n:] if n else sample)) + '\n')
   sys.stdout.flush()
 
 def print_header():
   C.printc('Global stats:')
   print("perf-tools' lbr.py module version %.2f" % __version__)
+
+# LbrStats - the analysis of the lbr_stats tool; args as its command-line
+class LbrStats(Analyzer):
+  dump_only = 0
+
+  def __init__(self, args=(), lines=None):
+    def arg(i, default): return args[i] if len(args) > i else default
+    ip = arg(0, 'ALL')
+    self.filter = None
+    self.c = {x: 0 for x in ('loop_head', 'loop_seq', 'loop_jmp2mid', 'loop_jmp2head', 'sequential', 'total')}
+    if ip not in ('ALL', '-'):
+      self.filter = '%x'%int(ip, 16) #asserts in hexa
+      self.c['ip'] = '0x'+self.filter
+    loop, self.hot = arg(1, '0'), 0
+    if loop.startswith('hot:'): loop, self.hot = 0, int(loop.split(':')[1])
+    else:
+      loop = [int(x, 16) for x in loop.split(',')]
+      loop = loop[0] if len(loop) == 1 else loop
+    self.loop, self.top, self.ev = loop, int(arg(2, '10')), arg(4, LBR_Event)
+    Analyzer.__init__(self, lines, ip_filter=self.filter, min_lines=2, loop_ipc=loop,
+      lp_stats_en=bool(int(arg(3, '0'))), event=self.ev, loop_hot=self.hot)
+
+  def on_sample(self, sample):
+    c = self.c
+    assert len(sample) > 2, 'invalid sample: ' + str(sample)
+    if self.dump_only:
+      print_sample(sample, 0)
+      sys.stdout.flush()
+      return
+    c['total'] += 1
+    if not sample[-2].taken: c['sequential'] += 1
+    if is_loop(sample[-1]):
+      c['loop_head'] += 1
+      if not sample[-2].taken: c['loop_seq'] += 1
+      elif sample[-2].taken and is_jmp_next(get_taken(sample, -1)): c['loop_jmp2head'] += 1
+      br = get_taken(sample, -2)
+      ip = sample[-1].ip
+      if br['to'] > ip and br['to'] <= get_loop(ip).back:
+        c['loop_jmp2mid'] += 1
+
+  def report(self):
+    if self.dump_only: return
+    with self:
+      c = self.c
+      if not self.loop and not self.hot: print_header()
+      if not self.ev.startswith(LBR_Event): print(c, ratio('sequential', c), ratio('loop_seq', c, 'loop_head'),
+        ratio('loop_jmp2mid', c, 'loop_head'), ratio('loop_jmp2head', c, 'loop_head'), sep=', ')
+      if self.filter:
+        for l in (hot_loops(self.hot) if self.hot else loop_ips(self.loop)) or [self.loop]: print_loop(l)
+        print(stat)
+      else:
+        print_all(self.top, loop_ipc=self.loop, loop_hot=self.hot)
+
+  def run(self): Analyzer.run(self, self.c)
@@ -5,26 +5,57 @@
 from __future__ import print_function
 __author__ = 'ayasin'
 
-import sys, os
+import sys, os, json
 import common as C
 
+#
+# descriptor of the PMU & CPU, resolved once. Set PMU_DESC=<file> to load one saved by './pmu.py <file>', e.g. to
+# analyze traces collected on another machine.
+#
+def desc():
+  if not desc.d: desc.d = desc_load(os.getenv('PMU_DESC')) if os.getenv('PMU_DESC') else desc_new(probe_name())
+  return desc.d
+desc.d = None
+
+def desc_new(name, smt_on=None):
+  d = {'name': name, 'smt-on': smt_on}
+  for x, n in (('skylake', 'skylake'), ('icelake', 'icelake'), ('alderlake', 'alderlake_hybrid'),
+               ('sapphire', 'sapphire_rapids')): d[x] = name == n
+  d['goldencove'] = d['alderlake'] or d['sapphire']
+  d['perfmetrics'] = d['icelake'] or d['goldencove']
+  d['width'] = 5 if d['icelake'] else (6 if d['goldencove'] else 4)
+  d['dsb-msb'] = 10 if d['goldencove'] else (9 if d['skylake'] or d['icelake'] else None)
+  return d
+
+def desc_load(f):
+  with open(f) as fd: x = json.load(fd)
+  d = desc_new(x['name'], x.get('smt-on'))
+  d.update(x)
+  return d
+
+def desc_save(f):
+  cpu('smt-on')
+  with open(f, 'w') as fd: json.dump(desc(), fd, indent=1, sort_keys=True)
+  C.printf('wrote: %s\n' % f)
+
 #
 # PMU, no prefix
 #
-def name():
+def probe_name():
   f = '/sys/devices/cpu_core' if os.path.isdir('/sys/devices/cpu_core') else '/sys/devices/cpu'
   f += '/caps/pmu_name'
   return C.file2str(f) or 'Unknown PMU'
+def name():       return desc()['name']
 
 # per CPU PMUs
-def skylake():    return name() == 'skylake'
-def icelake():    return name() == 'icelake'
-def alderlake():  return name() == 'alderlake_hybrid'
-def sapphire():   return name() == 'sapphire_rapids'
+def skylake():    return desc()['skylake']
+def icelake():    return desc()['icelake']
+def alderlake():  return desc()['alderlake']
+def sapphire():   return desc()['sapphire']
 
 # aggregations
-def goldencove():   return alderlake() or sapphire()
-def perfmetrics():  return icelake() or goldencove()
+def goldencove():   return desc()['goldencove']
+def perfmetrics():  return desc()['perfmetrics']
 # Icelake onward PMU, e.g. Intel PerfMon Version 5+
 def v5p(): return perfmetrics()
 
@@ -40,31 +71,31 @@ def cpu_has_feature(feature):
   return feature in flags
 
 def cpu(what):
-  if 1:  # not cpu.state:
+  d = desc()
+  if d['smt-on'] is None:
     sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/pmu-tools')
     import tl_cpu
-    cpu_state = tl_cpu.CPU((), False, tl_cpu.Env())
-  return {'smt-on': cpu_state.ht}[what]
-# cpu.state = None
+    d['smt-on'] = bool(tl_cpu.CPU((), False, tl_cpu.Env()).ht)
+  return {'smt-on': d['smt-on']}[what]
 
 def cpu_peak_kernels(widths=range(4, 7)):
   return ['peak%dwide' % x for x in widths]
 
-def cpu_pipeline_width():
-  width = 4
-  if icelake(): width = 5
-  elif goldencove(): width = 6
-  return width
+def cpu_pipeline_width(): return desc()['width']
 
 # deeper uarch stuff
 
 # returns MSB bit of DSB's set-index, if uarch is supported
-def dsb_msb():
-  return 10 if goldencove() else (9 if skylake() or icelake() else None)
+def dsb_msb(): return desc()['dsb-msb']
 
 def dsb_set_index(ip):
-  left = dsb_msb()
-  if left:
-    mask = 2 ** (left + 1) - 1
-    return ((ip & mask) >> 6)
-  return None
+  left = (desc.d or desc())['dsb-msb']
+  return (ip & (2 ** (left + 1) - 1)) >> 6 if left else None
+
+# usage: ./pmu.py [descriptor-file]
+#   prints the descriptor of this machine, or saves it for PMU_DESC
+if __name__ == '__main__':
+  if len(sys.argv) > 1: desc_save(sys.argv[1])
+  else:
+    cpu('smt-on')
+    print(json.dumps(desc(), indent=1, sort_keys=True))
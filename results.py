@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# A local database of profiling results, for queries and comparisons across runs
+# Author: Ahmad Yasin
+# edited: Oct. 2026
+#
+from __future__ import print_function
+__author__ = 'ayasin'
+
+import glob, os, re, sqlite3, sys, time
+import common as C
+
+#
+# runs:    one per profile run; name is the uniq_name() its logs are named by
+# metrics: per run; source is one of perf-stat<flags>, toplev<flags>, toplev-perf<flags> (its events), funcs or loops, with a numeric value and/or text
+#
+Schema = '''
+create table if not exists runs (id integer primary key, name text, cmd text, app text, time text, pmu text,
+  host text, setup text);
+create table if not exists metrics (run integer references runs(id), source text, name text, value real, text text);
+create index if not exists metrics_run on metrics(run);
+create index if not exists metrics_name on metrics(name);
+'''
+
+def connect(db):
+  con = sqlite3.connect(db)
+  con.executescript(Schema)
+  return con
+
+def number(x):
+  try:
+    return float(x.replace(',', ''))
+  except ValueError:
+    return None
+
+# perf stat, e.g. "  1,234,567      instructions   #  1.23  insn per cycle  ( +-  0.1% )" or "  1.2 +- 0.01 seconds time elapsed"
+def parse_perf_stat(f):
+  for line in C.file2lines(f, fail=True):
+    x = line.split('#')[0].split()
+    if len(x) < 2 or number(x[0]) is None: continue
+    if x[1] == '+-': x = x[:1] + x[3:] # the stddev of -r
+    if x[1] == 'seconds': yield ' '.join(x[1:4]).split('(')[0].strip(), number(x[0]), None
+    elif x[1] == 'msec' and len(x) > 2: yield x[2], number(x[0]), None
+    else: yield x[1], number(x[0]), None
+
+# toplev, e.g. "FE               Frontend_Bound                 % Slots              23.4   [20.0%] <=="
+Toplev_area = re.compile(r"((FE|BE|BAD|RET)(/\S+)?|Info\.\S+)$")
+def parse_toplev(f):
+  for line in C.file2lines(f, fail=True):
+    x = re.split(r'\s{2,}', line.strip())
+    if len(x) and re.match(r"[SC]\d", x[0]) and not Toplev_area.match(x[0]): x = x[1:] # a leading CPU/socket
+    if len(x) < 3 or not Toplev_area.match(x[0]): continue
+    for v in x[2:]:
+      v = number(v.split()[0])
+      if v is not None:
+        yield x[1], v, None
+        break
+
+# perf report -F sample,overhead,comm,dso,sym, e.g. "   1234  12.34%  app  app  [.] func"
+def parse_funcs(f):
+  for line in C.file2lines(f, fail=True):
+    m = re.match(r"\s*\d+\s+([\d.]+)%\s+\S+\s+\S+\s+\[.\]\s+(.*)", line)
+    if m: yield m.group(2).strip(), float(m.group(1)), None
+
+# toplev -V perf events, as in its -perf.csv; each summed over intervals and CPUs
+def parse_toplev_perf(f):
+  s = C.read_perf_toplev_series(f)
+  for e in s.events(): yield e, s.total(e), None
+
+# LBR_LOOPS_LOG of lbr_stats
+def parse_loops(f):
+  for line in C.file2lines(f, fail=True):
+    m = re.search(r"ip: (0x[0-9a-f]+), hotness:\s+(\d+)", line)
+    if m: yield 'loop:' + m.group(1), int(m.group(2)), line
+
+# key metrics of a run, to judge its variance by: time, IPC and topdown level-1 fractions, in % as of toplev
+def stat_metrics(f):
+  ev, m = {}, {}
+  for n, v, _ in parse_perf_stat(f):
+    n = n.rstrip('/').split('/')[-1] # e.g. cpu_core/instructions/
+    ev[n] = ev.get(n, 0) + v
+  if 'seconds time elapsed' in ev: m['time'] = ev['seconds time elapsed']
+  if ev.get('cycles'): m['IPC'] = ev.get('instructions', 0) / ev['cycles']
+  if ev.get('slots'):
+    for n in ev:
+      if n.startswith('topdown-'): m[n] = 100.0 * ev[n] / ev['slots']
+  return m
+
+Toplev_L1 = ('Frontend_Bound', 'Bad_Speculation', 'Backend_Bound', 'Retiring', 'IPC')
+def toplev_metrics(f):
+  return {n: v for n, v, _ in parse_toplev(f) if n in Toplev_L1}
+
+Sources = (('perf-stat', '%s.perf_stat*.log', parse_perf_stat), ('toplev', '%s.toplev*.log', parse_toplev),
+           ('toplev-perf', '%s.toplev*-perf.csv', parse_toplev_perf),
+           ('funcs', '%s.perf*-funcs.log', parse_funcs), ('loops', '%s-*.loops.log', parse_loops))
+
+# add - index the logs of a run named name; returns its id
+def add(db, name, cmd='', app='', pmu='', setup='setup-system.log'):
+  con = connect(db)
+  with con:
+    run = con.execute('insert into runs (name, cmd, app, time, pmu, host, setup) values (?, ?, ?, ?, ?, ?, ?)',
+      (name, cmd, app, time.strftime('%Y-%m-%d %H:%M:%S'), pmu, os.uname()[1],
+       '\n'.join(C.file2lines(setup)) if os.path.isfile(setup) else None)).lastrowid
+    for source, pattern, parse in Sources:
+      for f in sorted(glob.glob(pattern % name)):
+        prefix, suffix = (pattern % name).split('*')
+        tag = f[len(prefix):-len(suffix)] if source.startswith(('perf-stat', 'toplev')) else ''
+        con.executemany('insert into metrics values (?, ?, ?, ?, ?)',
+          ((run, source + tag, n, v, t) for n, v, t in parse(f)))
+  con.close()
+  C.printf('results: added run %d of %s to %s\n' % (run, name, db))
+  return run
+
+def run_id(con, x):
+  r = con.execute('select max(id) from runs where name = ? or id = ?', (x, x)).fetchone()[0]
+  if r is None: C.error('results: no such run %s' % x)
+  return r
+
+# runs - list runs whose name matches a LIKE pattern
+def runs(db, pattern='%'):
+  con = connect(db)
+  print('%4s %-19s %-16s %-40s %s' % ('id', 'time', 'pmu', 'name', 'metrics'))
+  for r in con.execute('select id, time, pmu, name, (select count(*) from metrics where run = id) from runs '
+                       'where name like ? order by id', (pattern, )):
+    print('%4d %-19s %-16s %-40s %d' % r)
+
+def metrics(con, run, pattern='%'):
+  return {(s, n): v for s, n, v in con.execute('select source, name, value from metrics where run = ? and name like ?',
+                                                (run, pattern))}
+
+# show - metrics of a run, by id or name (its latest one)
+def show(db, x, pattern='%'):
+  con = connect(db)
+  run = run_id(con, x)
+  for (s, n), v in sorted(metrics(con, run, pattern).items()): print('%-24s %-48s %16s' % (s, n, v))
+
+# diff - metrics of two runs side by side, with the relative change
+def diff(db, x, y, pattern='%', threshold=0.0):
+  con = connect(db)
+  a, b = (metrics(con, run_id(con, r), pattern) for r in (x, y))
+  print('%-24s %-48s %16s %16s %8s' % ('source', 'metric', x, y, 'change'))
+  for k in sorted(set(a) | set(b)):
+    va, vb = a.get(k), b.get(k)
+    d = 100.0 * (vb - va) / abs(va) if va and vb is not None else None
+    if d is not None and abs(d) < threshold: continue
+    print('%-24s %-48s %16s %16s %8s' % (k[0], k[1], va, vb, '%+.1f%%' % d if d is not None else '-'))
+
+# query - a metric across runs whose name matches a LIKE pattern
+def query(db, metric, pattern='%'):
+  con = connect(db)
+  for r in con.execute('select runs.id, runs.name, source, metrics.name, value from metrics join runs on run = runs.id '
+                       'where metrics.name like ? and runs.name like ? order by runs.id', (metric, pattern)):
+    print('%4d %-40s %-20s %-40s %16s' % r)
+
+# usage: ./results.py db add|runs|show|diff|query [args]
+if __name__ == "__main__":
+  db, cmd, args = C.arg(1), C.arg(2), sys.argv[3:]
+  if cmd == 'add': add(db, *args)
+  elif cmd == 'runs': runs(db, *args)
+  elif cmd == 'show': show(db, *args)
+  elif cmd == 'diff': diff(db, *args[:3] + [float(x) for x in args[3:4]])
+  elif cmd == 'query': query(db, *args)
+  else: C.error('results: unknown command %s' % cmd)